@@ -27,24 +27,36 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 # 
+import deform
+from deform.template import ZPTRendererFactory
+
 from pyramid.config import Configurator
+from pyramid.settings import asbool
 
 from pyramid.events import subscriber
 from pyramid.events import BeforeRender
 
-from pyramid.authentication import AuthTktAuthenticationPolicy
-
 from resources import bootstrap
 from pyramid.exceptions import ConfigurationError, NotFound
 from pyramid.httpexceptions import HTTPNotFound
 from pyramid.view import append_slash_notfound_view
 
-from backends import load_backends
+from backends import load_backend, parsed_files, BackendRegistry
+from jobs import ApplyQueue
+from userdb import TicketOrBasicAuthenticationPolicy, DEFAULT_CREDENTIALS_TTL
 
 
-def add_global_texts(backend):
+def add_global_texts(backend, groups):
+    # the texts of the backend of the group shown, if any
     def events(event):
-        event['texts'] = backend.get_texts()
+        request = event.get('request')
+        groupname = None
+        if request is not None and request.matchdict:
+            groupname = request.matchdict.get('groupname')
+        if groupname in groups.files:
+            event['texts'] = groups.backend_of(groupname).get_texts()
+        else:
+            event['texts'] = backend.get_texts()
     return events
 
 def notfound(request):
@@ -65,30 +77,60 @@ def get_protected_names(settings):
 
     return protected
 
-def get_files(settings):
+def parse_files(settings):
+    """(name, backend, filename) of every group, lines are name:filename
+    for groups of the default ninjasysop.backend or name:backend:filename"""
     raw = settings.get('ninjasysop.files', None)
     if raw is None:
         raise ConfigurationError("Not config files set")
 
-    files = {}
+    default = settings.get('ninjasysop.backend')
+    groups = []
     for item in raw.split('\n'):
         if not item:
             continue
-        name, filename = item.split(':')
-        files[name] = filename
-
-    return files
+        fields = item.split(':')
+        if len(fields) == 3:
+            name, backend, filename = fields
+        else:
+            name, filename = fields
+            backend = default
+        if not backend:
+            raise ConfigurationError("Not backend set for %s" % name)
+        groups.append((name, backend, filename))
+
+    return groups
+
+def get_files(settings, backend=None):
+    # files by group name, only those of backend if given
+    return dict((name, filename)
+                for (name, group_backend, filename) in parse_files(settings)
+                if backend is None or group_backend == backend)
+
+def get_backends(settings):
+    # backend name by group name
+    return dict((name, backend)
+                for (name, backend, filename) in parse_files(settings))
 
 
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
+    credentials_ttl = int(settings.get('ninjasysop.credentials_ttl',
+                                       DEFAULT_CREDENTIALS_TTL))
     config = Configurator(
         settings=settings,
         root_factory=bootstrap,
-        authentication_policy=AuthTktAuthenticationPolicy(
-            'seekr1t'),
+        authentication_policy=TicketOrBasicAuthenticationPolicy(
+            'seekr1t', settings.get('ninjasysop.htpasswd'), credentials_ttl),
     )
+    config.add_settings(credentials_ttl=credentials_ttl)
+
+    # otherwise deform looks for changes of its templates on every render
+    if not asbool(settings.get('pyramid.reload_templates', False)):
+        search_path = deform.Form.default_renderer.loader.search_path
+        deform.Form.set_default_renderer(
+            ZPTRendererFactory(search_path, auto_reload=False))
 
     config.add_static_view('static', 'static/',
                            cache_max_age=86400)
@@ -103,7 +145,12 @@ def main(global_config, **settings):
     config.add_route('backend_rest_view','api/')
     config.add_route('backend_rest_edit_schema', 'api/schema/edit/')
     config.add_route('backend_rest_add_schema', 'api/schema/add/')
+    config.add_route('backend_rest_lookup', 'api/lookup/')
     config.add_route('group_rest_view', 'api/{groupname}/')
+    config.add_route('group_rest_apply', 'api/{groupname}/applychanges/')
+    config.add_route('group_rest_revisions', 'api/{groupname}/revisions/')
+    config.add_route('group_rest_import', 'api/{groupname}/import/')
+    config.add_route('group_rest_batch', 'api/{groupname}/batch/')
     config.add_route('item_rest_view', 'api/{groupname}/{itemname}/')
 
     config.add_route('group_items', '{groupname}/')
@@ -116,17 +163,38 @@ def main(global_config, **settings):
 
     config.add_view(append_slash_notfound_view, context=NotFound)
 
+    group_backends = get_backends(settings)
+    # the default backend, for pages that are not about one group
     backend_name = settings.get('ninjasysop.backend')
-
-    allbackends = load_backends()
-    backend = allbackends[backend_name]
+    if not backend_name and group_backends:
+        backend_name = group_backends[sorted(group_backends)[0]]
+    if not backend_name:
+        raise ConfigurationError('A backend or backends definition are needed')
+
+    backends = {}
+    for name in set(group_backends.values()) | set([backend_name]):
+        backends[name] = load_backend(name)
+        if backends[name] is None:
+            raise ConfigurationError("Backend %s not found" % name)
+        backends[name].configure(settings)
+    backend = backends[backend_name]
     config.add_settings(backend=backend)
+    config.add_settings(backends=backends)
+
+    apply_queue = ApplyQueue(
+        delay=float(settings.get('ninjasysop.apply_delay', 2)),
+        max_delay=float(settings.get('ninjasysop.apply_max_delay', 30)),
+        workers=int(settings.get('ninjasysop.apply_workers', 2)))
+    config.add_settings(apply_queue=apply_queue)
 
     htpasswd_file = settings.get('ninjasysop.htpasswd')
 
     config.add_settings(htpasswd=htpasswd_file)
 
-    config.add_subscriber(add_global_texts(backend), BeforeRender)
+    # parsed files cache size in MB
+    cache_size = settings.get('ninjasysop.cache_size')
+    if cache_size:
+        parsed_files.resize(int(cache_size) * 1024 * 1024)
 
     files=get_files(settings)
     protected_names = get_protected_names(settings)
@@ -134,15 +202,23 @@ def main(global_config, **settings):
         if key not in protected_names:
             protected_names[key] = []
     config.add_settings(files=files)
+    groups = BackendRegistry(backend, files,
+                             dict((groupname, backends[name])
+                                  for (groupname, name)
+                                  in group_backends.items()))
+    config.add_settings(groups=groups)
+    config.add_subscriber(add_global_texts(backend, groups), BeforeRender)
     config.add_settings(protected_names=protected_names)
 
     htpasswd_file = settings.get('ninjasysop.htpasswd')
     config.add_settings(htpasswd=htpasswd_file)
 
-    if not backend:
-        ConfigurationError('A backend or backends definition are needed')
+    # parse every group before serving, not on their first request
+    warmup_workers = int(settings.get('ninjasysop.warmup_workers', 0))
+    if warmup_workers:
+        groups.warm_up(warmup_workers)
 
-    config.scan()
+    config.scan('.views')
 
     return config.make_wsgi_app()
 
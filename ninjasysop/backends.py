@@ -27,22 +27,166 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 # 
-import pkg_resources
+import bisect
+import copy
+import logging
+import os
+import signal
+import stat
+import subprocess
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 ENTRYPOINT = 'ninjasysop.plugins'
 
+# Bytes of source files kept parsed in memory
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+
+# Seconds a reload command may run
+APPLY_TIMEOUT = 60
+
+log = logging.getLogger(__name__)
+
 
 class BackendApplyChangesException(Exception):
     pass
 
 
+def run_command(command, timeout=None, input=None):
+    """Runs a shell command, killing it after timeout seconds.
+
+    input is written to its standard input. Returns its output, raises BackendApplyChangesException when the
+    command fails or times out.
+    """
+    # own process group, so the shell and its children are killed together
+    stdin = subprocess.PIPE if input is not None else None
+    process = subprocess.Popen(command, shell=True, stdin=stdin,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT,
+                               preexec_fn=os.setsid)
+    timed_out = []
+    def kill():
+        timed_out.append(True)
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    try:
+        output = process.communicate(input)[0]
+    finally:
+        if timer:
+            timer.cancel()
+
+    if timed_out:
+        raise BackendApplyChangesException(
+            "%s\n%s timed out after %s seconds" % (output, command, timeout))
+    if process.returncode:
+        raise BackendApplyChangesException(output)
+    return output
+
+
+class RWLock(object):
+    """Many readers or one writer, waiting writers go first.
+
+    The thread holding the write lock may take it, or the read lock,
+    again.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._depth = 0
+        self._writers_waiting = 0
+
+    @contextmanager
+    def reading(self):
+        if self._writer == threading.current_thread():
+            yield
+            return
+        with self._condition:
+            while self._writer is not None or self._writers_waiting:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def writing(self):
+        me = threading.current_thread()
+        with self._condition:
+            if self._writer != me:
+                self._writers_waiting += 1
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+                self._writers_waiting -= 1
+                self._writer = me
+            self._depth += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._depth -= 1
+                if not self._depth:
+                    self._writer = None
+                    self._condition.notify_all()
+
+
 class Backend(object):
 
-    _shared_states = {}
+    apply_timeout = APPLY_TIMEOUT
+    revisions_keep = 0
+    # fields telling apart the items sharing a name, get_item, del_item
+    # and get_edit_schema take them as keyword arguments
+    item_keys = ()
+
     def __init__(self, name, filename):
-        self.__dict__ = self._shared_states
         self.name = name
         self.filename = filename
+        self.lock = RWLock()
+        # identity of the file the group holds, see ParsedFileCache.stamp
+        self.stamp = None
+
+    def refresh(self):
+        # loads the file again when it changed, called with the write lock
+        pass
+
+    def stale(self):
+        # the file changed since the group was read or written
+        return parsed_files.stamp(self.filename) != self.stamp
+
+    def _update_cache(self):
+        # stores the parsed group as the content of its file
+        pass
+
+    @contextmanager
+    def batch(self):
+        """Edits made inside write the file once, when it ends. If it
+        raises, or the write fails, the file is left alone and the group
+        is read from it again. Called with the write lock."""
+        try:
+            with atomic_files.deferred(self.filename):
+                yield self
+        except:
+            parsed_files.invalidate(self.filename)
+            self.stamp = None
+            self.refresh()
+            raise
+        self._update_cache()
 
     def get_name(self):
         return self.name
@@ -59,12 +203,22 @@ class Backend(object):
     def get_items(self, **kwargs):
         raise NotImplementedError("Not get_items implemented")
 
+    def item_selector(self, item):
+        # the item_keys values of item
+        return dict((key, getattr(item, key)) for key in self.item_keys)
+
     def add_item(self, **kwargs):
         raise NotImplementedError("Not add_item implemented")
 
     def save_item(self, **kwargs):
         raise NotImplementedError("Not save_item implemented")
 
+    def validate_items(self, objs):
+        raise NotImplementedError("Not validate_items implemented")
+
+    def add_items(self, objs):
+        raise NotImplementedError("Not add_items implemented")
+
     def get_edit_schema(self):
         raise NotImplementedError("Not get_editform implemented")
 
@@ -72,8 +226,45 @@ class Backend(object):
         raise NotImplementedError("Not get_addform implemented")
 
     def apply_changes(self, username):
+        """Saves the group as a new revision, called with the write lock.
+        Returns the revision for reload()"""
         raise NotImplementedError("Not apply_changes implemented")
 
+    def reload(self, revision):
+        # makes the service load the applied revision, called without the
+        # lock, so the group is read and edited meanwhile
+        raise NotImplementedError("Not reload implemented")
+
+    def get_revisions(self):
+        raise NotImplementedError("Not get_revisions implemented")
+
+    def get_stats(self):
+        # (label, value) pairs shown with the items of the group
+        return []
+
+    def restore_revision(self, serial):
+        raise NotImplementedError("Not restore_revision implemented")
+
+    @classmethod
+    def lookup(cls, **kwargs):
+        raise NotImplementedError("Not lookup implemented")
+
+    @classmethod
+    def source_files(cls, filename):
+        # files a group is read from, any change to them changes its ETag
+        return [filename]
+
+    @classmethod
+    def source_state(cls):
+        # values besides the files the group page depends on, in its ETag
+        return ()
+
+    @classmethod
+    def configure(cls, settings):
+        cls.apply_timeout = int(settings.get('ninjasysop.apply_timeout',
+                                             APPLY_TIMEOUT))
+        cls.revisions_keep = int(settings.get('ninjasysop.revisions_keep', 0))
+
     @classmethod
     def get_edit_schema_definition(self):
         raise NotImplementedError("Not edit schema definition implemented")
@@ -91,7 +282,593 @@ class Backend(object):
         return self.__name__
 
 
+class ParsedFileCache(object):
+    """Process wide cache of parsed backend files.
+
+    Entries are keyed by path and checked against the file identity
+    (device, inode, mtime, size), so an unchanged file is never parsed
+    twice. The least recently used entries are dropped when the size of
+    the cached files goes over max_size bytes, and the listeners are told
+    with their evicted(filename) so they drop their own references.
+    """
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.listeners = weakref.WeakSet()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def stamp(self, filename):
+        stat = os.stat(filename)
+        return (stat.st_dev, stat.st_ino,
+                getattr(stat, 'st_mtime_ns', stat.st_mtime), stat.st_size)
+
+    def get(self, filename, parser):
+        filename = os.path.abspath(filename)
+        stamp = self.stamp(filename)
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is not None and entry[0] == stamp:
+                # move to the most recently used end
+                del self._entries[filename]
+                self._entries[filename] = entry
+                return entry[1]
+
+        # the stamp is taken before parsing, a file changed meanwhile
+        # will be parsed again on the next call
+        value = parser()
+        self.set(filename, value, stamp)
+        return value
+
+    def set(self, filename, value, stamp=None):
+        """Stores value as the parsed filename, returns its stamp"""
+        filename = os.path.abspath(filename)
+        if stamp is None:
+            stamp = self.stamp(filename)
+        with self._lock:
+            self._discard(filename)
+            self._entries[filename] = (stamp, value)
+            self.size += stamp[3]
+            evicted = self._evict()
+        self._notify(evicted)
+        return stamp
+
+    def update(self, filename, value):
+        # Called by backends after writing the file themselves, the parsed
+        # value is still valid for the new file identity.
+        return self.set(filename, value)
+
+    def invalidate(self, filename):
+        with self._lock:
+            self._discard(os.path.abspath(filename))
+
+    def resize(self, max_size):
+        with self._lock:
+            self.max_size = max_size
+            evicted = self._evict()
+        self._notify(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __contains__(self, filename):
+        return os.path.abspath(filename) in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _discard(self, filename):
+        entry = self._entries.pop(filename, None)
+        if entry is not None:
+            self.size -= entry[0][3]
+
+    def _evict(self):
+        # always keep the newest entry, even if it is bigger than max_size
+        evicted = []
+        while self.size > self.max_size and len(self._entries) > 1:
+            filename, (stamp, value) = self._entries.popitem(last=False)
+            self.size -= stamp[3]
+            evicted.append(filename)
+        return evicted
+
+    def _notify(self, evicted):
+        # out of the lock, the listeners may use the cache
+        for filename in evicted:
+            for listener in list(self.listeners):
+                listener.evicted(filename)
+
+
+parsed_files = ParsedFileCache()
+
+
+class _PendingWrite(object):
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.content = None
+        self.submitted = 0
+        self.written = 0
+        self.writing = False
+        # threads writing the file, it is forgotten when none is left
+        self.users = 0
+
+
+class AtomicWriter(object):
+    """Replaces whole files through a sibling temporary file.
+
+    The content is written and fsynced to a temporary file in the same
+    directory, which is then renamed over the original one, so readers
+    see either the old or the new file, never a partial one.
+
+    Writes to the same file are group committed: while one thread is
+    writing, the others only leave their content, and the next write
+    stores the latest content for all of them. Backends always hand the
+    whole file content, so a burst of edits pays a few fsyncs, not one
+    per edit, and every write call returns once its content is durable.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._local = threading.local()
+
+    def write(self, filename, content):
+        """content is the text of the file, or a function returning it"""
+        filename = os.path.abspath(filename)
+        deferred = getattr(self._local, 'deferred', None)
+        if deferred is not None and filename in deferred:
+            deferred[filename] = content
+            return
+        if callable(content):
+            content = content()
+
+        with self._lock:
+            pending = self._pending.setdefault(filename, _PendingWrite())
+            pending.users += 1
+
+        try:
+            self._write(filename, pending, content)
+        finally:
+            with self._lock:
+                pending.users -= 1
+                if not pending.users:
+                    del self._pending[filename]
+
+    def _write(self, filename, pending, content):
+        with pending.condition:
+            pending.submitted += 1
+            ticket = pending.submitted
+            pending.content = content
+            while pending.written < ticket:
+                if pending.writing:
+                    pending.condition.wait()
+                    continue
+
+                pending.writing = True
+                content = pending.content
+                batch = pending.submitted
+                pending.condition.release()
+                try:
+                    self._replace(filename, content)
+                finally:
+                    pending.condition.acquire()
+                    pending.writing = False
+                    pending.condition.notify_all()
+                pending.written = batch
+
+    @contextmanager
+    def deferred(self, filename):
+        """Holds back the writes of filename made by this thread inside,
+        only the last one is done when it ends, none if it raises"""
+        filename = os.path.abspath(filename)
+        if getattr(self._local, 'deferred', None) is None:
+            self._local.deferred = {}
+        deferred = self._local.deferred
+        if filename in deferred:
+            # the outermost one writes
+            yield
+            return
+
+        deferred[filename] = None
+        try:
+            yield
+        except:
+            del deferred[filename]
+            raise
+        content = deferred.pop(filename)
+        if content is not None:
+            self.write(filename, content)
+
+    def _replace(self, filename, content):
+        dirname, basename = os.path.split(filename)
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.%s.' % basename,
+                                       suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as tmpfile:
+                self._copy_owner(filename, tmpfile.fileno())
+                tmpfile.write(content)
+                tmpfile.flush()
+                os.fsync(tmpfile.fileno())
+            os.rename(tmpname, filename)
+        except:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+            raise
+
+        # make the rename itself durable
+        dirfd = os.open(dirname, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+
+    def _copy_owner(self, filename, fd):
+        try:
+            filestat = os.stat(filename)
+        except OSError:
+            return
+        os.fchmod(fd, stat.S_IMODE(filestat.st_mode))
+        try:
+            os.fchown(fd, filestat.st_uid, filestat.st_gid)
+        except OSError:
+            # only root can give files away
+            pass
+
+
+atomic_files = AtomicWriter()
+
+
+def _bucket_add(buckets, key, item):
+    # most values belong to a single item, a set is only built for the rest
+    bucket = buckets.get(key)
+    if bucket is None:
+        buckets[key] = item
+    elif isinstance(bucket, set):
+        bucket.add(item)
+    else:
+        buckets[key] = set((bucket, item))
+
+
+def _bucket_remove(buckets, key, item):
+    bucket = buckets.get(key)
+    if isinstance(bucket, set):
+        bucket.discard(item)
+        if len(bucket) == 1:
+            buckets[key] = bucket.pop()
+    elif bucket is item:
+        del buckets[key]
+
+
+class ItemPage(list):
+    """One slice of the matching items, total is the count of all of them"""
+
+    def __init__(self, items, total):
+        list.__init__(self, items)
+        self.total = total
+
+
+def _bucket_items(buckets, key):
+    bucket = buckets.get(key)
+    if bucket is None:
+        return set()
+    elif isinstance(bucket, set):
+        return bucket
+    return set((bucket,))
+
+
+class ItemIndex(object):
+    """Secondary indexes over the items of a group.
+
+    Keeps a hash index from value to items for each of fields, and one
+    for the exact name. normalize maps a field to a function applied to
+    its values, both when indexing and when looking up. Substring
+    searches on names use an index of name trigrams.
+
+    The indexes are built from items the first time they are queried, so
+    loading a group that is never searched costs nothing more, and are
+    maintained by add and remove from then on. So is the list of the
+    items sorted by name, used to page through a group without sorting
+    it for every page.
+    """
+
+    NGRAM = 3
+
+    def __init__(self, items, fields, normalize=None):
+        self.items = items
+        self.fields = fields
+        self.normalize = normalize or {}
+        self.values = None
+        self.names = None
+        self.ngrams = None
+        self.sorted = None
+
+    def _value(self, field, value):
+        if field in self.normalize:
+            return self.normalize[field](value)
+        return value
+
+    def _ngrams(self, name):
+        return set(name[i:i + self.NGRAM]
+                   for i in xrange(len(name) - self.NGRAM + 1))
+
+    def _build(self):
+        if self.names is None:
+            self.values = dict((field, {}) for field in self.fields)
+            self.names = {}
+            for item in self.items:
+                self._add(item)
+
+    def _sort_key(self, item):
+        # names repeat in round robins and rrsets, id keeps keys unique
+        return (item.name, id(item))
+
+    def _sort(self):
+        if self.sorted is None:
+            self.sorted = sorted(self._sort_key(item) + (item,)
+                                 for item in self.items)
+        return self.sorted
+
+    def add(self, item):
+        if self.sorted is not None:
+            bisect.insort(self.sorted, self._sort_key(item) + (item,))
+        if self.names is not None:
+            self._add(item)
+
+    def _add(self, item):
+        for field in self.fields:
+            _bucket_add(self.values[field],
+                        self._value(field, getattr(item, field)), item)
+        if item.name not in self.names and self.ngrams is not None:
+            for ngram in self._ngrams(item.name):
+                self.ngrams.setdefault(ngram, set()).add(item.name)
+        _bucket_add(self.names, item.name, item)
+
+    def remove(self, item):
+        if self.sorted is not None:
+            i = bisect.bisect_left(self.sorted, self._sort_key(item))
+            if i < len(self.sorted) and self.sorted[i][-1] is item:
+                del self.sorted[i]
+        if self.names is None:
+            return
+        for field in self.fields:
+            _bucket_remove(self.values[field],
+                           self._value(field, getattr(item, field)), item)
+        _bucket_remove(self.names, item.name, item)
+        if item.name not in self.names and self.ngrams is not None:
+            for ngram in self._ngrams(item.name):
+                names = self.ngrams[ngram]
+                names.discard(item.name)
+                if not names:
+                    del self.ngrams[ngram]
+
+    def lookup(self, field, value):
+        self._build()
+        return _bucket_items(self.values[field], self._value(field, value))
+
+    def lookup_name(self, name):
+        self._build()
+        return _bucket_items(self.names, name)
+
+    def search(self, text):
+        self._build()
+        if len(text) < self.NGRAM:
+            names = [name for name in self.names if text in name]
+        else:
+            if self.ngrams is None:
+                self.ngrams = {}
+                for name in self.names:
+                    for ngram in self._ngrams(name):
+                        self.ngrams.setdefault(ngram, set()).add(name)
+            candidates = sorted((self.ngrams.get(ngram, set())
+                                 for ngram in self._ngrams(text)), key=len)
+            names = [name for name in candidates[0].intersection(*candidates[1:])
+                     if text in name]
+
+        items = set()
+        for name in names:
+            items.update(_bucket_items(self.names, name))
+        return items
+
+    def filter(self, name=None, name_exact=None, offset=0, limit=None,
+               order=None, **fields):
+        """Items matching all the given values
+
+        Returns an ItemPage with limit items from offset, ordered by the
+        field named in order ('-field' for descending), and the count of
+        all the matches.
+        """
+        matches = []
+        if name_exact:
+            matches.append(self.lookup_name(name_exact))
+        for (field, value) in fields.items():
+            if value:
+                matches.append(self.lookup(field, value))
+
+        if matches:
+            matches.sort(key=len)
+            result = matches[0].intersection(*matches[1:])
+            if name:
+                result = [item for item in result if name in item.name]
+        elif name:
+            result = self.search(name)
+        elif order in ('name', '-name'):
+            return self._page(offset, limit, order == '-name')
+        else:
+            result = self.items
+
+        result = list(result)
+        if order:
+            field = order.lstrip('-')
+            result.sort(key=lambda item: getattr(item, field),
+                        reverse=order.startswith('-'))
+        end = offset + limit if limit is not None else None
+        return ItemPage(result[offset:end], len(result))
+
+    def _page(self, offset, limit, reverse):
+        items = self._sort()
+        total = len(items)
+        if reverse:
+            stop = max(total - offset, 0)
+            start = max(stop - limit, 0) if limit is not None else 0
+            keys = reversed(items[start:stop])
+        else:
+            stop = offset + limit if limit is not None else None
+            keys = items[offset:stop]
+        return ItemPage([key[-1] for key in keys], total)
+
+
+class IndexedItems(dict):
+    """Items by name, with an ItemIndex kept up to date.
+
+    Only item assignment and deletion update the index.
+    """
+
+    def __init__(self, fields, normalize=None):
+        dict.__init__(self)
+        self.index = ItemIndex(self.viewvalues(), fields, normalize)
+
+    def __setitem__(self, name, item):
+        if dict.__contains__(self, name):
+            self.index.remove(self[name])
+        dict.__setitem__(self, name, item)
+        self.index.add(item)
+
+    def __delitem__(self, name):
+        self.index.remove(self[name])
+        dict.__delitem__(self, name)
+
+    def filter(self, **kwargs):
+        return self.index.filter(**kwargs)
+
+
+class BackendRegistry(object):
+    """One long lived backend per group, shared by the requests.
+
+    reading() and writing() give the backend of a group, refreshed from
+    its file, while holding its read or write lock. group_backends maps
+    the groups served by other backend classes than backend.
+
+    The backend of a group is dropped when its file leaves parsed_files,
+    so the cache size bounds the memory of the parsed groups. The locks
+    are kept by name, the backend built again shares the lock of the
+    dropped one.
+    """
+
+    def __init__(self, backend, files, group_backends=None):
+        self.backend = backend
+        self.files = files
+        self.group_backends = group_backends or {}
+        self._groups = {}
+        self._locks = dict((groupname, RWLock()) for groupname in files)
+        self._lock = threading.Lock()
+        self._file_groups = {}
+        for (groupname, filename) in files.items():
+            if filename:
+                self._file_groups.setdefault(os.path.abspath(filename),
+                                             []).append(groupname)
+        parsed_files.listeners.add(self)
+
+    def backend_of(self, groupname):
+        return self.group_backends.get(groupname, self.backend)
+
+    def get(self, groupname):
+        group = self._groups.get(groupname)
+        if group is None:
+            # parsed out of the lock, the first one stored wins
+            group = self.backend_of(groupname)(groupname,
+                                               self.files[groupname])
+            group.lock = self._locks[groupname]
+            with self._lock:
+                group = self._groups.setdefault(groupname, group)
+        return group
+
+    def evicted(self, filename):
+        with self._lock:
+            for groupname in self._file_groups.get(filename, ()):
+                self._groups.pop(groupname, None)
+
+    @contextmanager
+    def reading(self, groupname):
+        group = self.get(groupname)
+        with group.lock.reading():
+            stale = group.stale()
+        if stale:
+            # refresh() checks the file again with the write lock
+            with group.lock.writing():
+                group.refresh()
+        with group.lock.reading():
+            yield group
+
+    @contextmanager
+    def writing(self, groupname):
+        group = self.get(groupname)
+        with group.lock.writing():
+            group.refresh()
+            yield group
+
+    def warm_up(self, workers):
+        """Loads every group on a pool of workers threads.
+
+        Returns the names of the groups that failed to load, they are
+        tried again when requested.
+        """
+        pool = ThreadPool(workers)
+        try:
+            failed = pool.map(self._warm_up, sorted(self.files))
+        finally:
+            pool.close()
+            pool.join()
+        return [groupname for groupname in failed if groupname]
+
+    def _warm_up(self, groupname):
+        try:
+            self.get(groupname)
+        except Exception, e:
+            log.warning("Can not load %s: %s", groupname, e)
+            return groupname
+
+
+# schema class -> the instance shared by bound_schema
+_schema_prototypes = {}
+
+
+def bound_schema(schema_class, validator=None, **changes):
+    """A schema of schema_class for one request, checked by validator.
+
+    The class is instantiated once and shared. Each call gets a shallow
+    copy of it, where only the nodes named in changes are copied and
+    given the attributes of their dict (widget, default, description).
+    """
+    prototype = _schema_prototypes.get(schema_class)
+    if prototype is None:
+        prototype = _schema_prototypes.setdefault(schema_class,
+                                                  schema_class())
+    schema = copy.copy(prototype)
+    schema.validator = validator
+    schema.children = list(prototype.children)
+    for (n, node) in enumerate(schema.children):
+        if node.name in changes:
+            node = schema.children[n] = copy.copy(node)
+            for (attr, value) in changes[node.name].items():
+                setattr(node, attr, value)
+    return schema
+
+
+def load_backend(name):
+    """Imports the backend class of the plugin called name, and only it"""
+    # importing pkg_resources scans every installed distribution
+    import pkg_resources
+    for entrypoint in pkg_resources.iter_entry_points(ENTRYPOINT, name):
+        # resolve skips checking the requirements of the distribution
+        return entrypoint.resolve()
+    return None
+
+
 def load_backends():
+    import pkg_resources
     Backends = {}
     for entrypoint in pkg_resources.iter_entry_points(ENTRYPOINT):
         backend_class = entrypoint.load()
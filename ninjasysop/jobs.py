@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) <2012> Antonio Pérez-Aranda Alcaide (ant30) <ant30tx@gmail.com>
+#                      Antonio Pérez-Aranda Alcaide (Yaco Sistemas SL) <aperezaranda@yaco.es>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of copyright holders nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL COPYRIGHT HOLDERS OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from backends import BackendApplyChangesException
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+log = logging.getLogger(__name__)
+
+
+class ApplyJob(object):
+    def __init__(self, id, groupname, apply, not_before):
+        self.id = id
+        self.groupname = groupname
+        self.apply = apply
+        self.usernames = []
+        self.state = PENDING
+        self.output = ''
+        self.created = datetime.now()
+        self.started = None
+        self.finished = None
+        self.not_before = not_before
+        # an apply is never delayed past this time by new requests
+        self.deadline = None
+
+    def __str__(self):
+        return str(self.id)
+
+    def todict(self):
+        def isoformat(date):
+            return date.isoformat() if date else None
+        return dict(id = self.id,
+                    groupname = self.groupname,
+                    usernames = self.usernames,
+                    state = self.state,
+                    output = self.output,
+                    created = isoformat(self.created),
+                    started = isoformat(self.started),
+                    finished = isoformat(self.finished))
+
+
+class ApplyQueue(object):
+    """Runs the apply changes of the groups on background threads.
+
+    An apply waits delay seconds before it runs. Requests for a group
+    with a pending job join that job and push its start further, up to
+    max_delay seconds after the first request, so a burst of applies
+    on a group reloads the service once. A group never runs two jobs at
+    a time, and the last history finished jobs are kept for their status.
+    """
+
+    def __init__(self, delay=2, max_delay=30, workers=2, history=1000):
+        self.delay = delay
+        self.max_delay = max_delay
+        self.workers = workers
+        self.history = history
+        self.jobs = OrderedDict()
+        self.pending = {}
+        self.running = set()
+        self._ids = itertools.count(1)
+        self._condition = threading.Condition()
+        self._threads = []
+
+    def submit(self, groupname, username, apply):
+        """Queues apply(username) for groupname, returns its job"""
+        now = time.time()
+        with self._condition:
+            job = self.pending.get(groupname)
+            if job is None:
+                job = ApplyJob(self._ids.next(), groupname, apply,
+                               now + self.delay)
+                job.deadline = now + self.max_delay
+                self.pending[groupname] = job
+                self.jobs[job.id] = job
+                self._trim()
+            else:
+                job.apply = apply
+                job.not_before = min(now + self.delay, job.deadline)
+
+            if username not in job.usernames:
+                job.usernames.append(username)
+            self._start_workers()
+            self._condition.notify_all()
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def last(self, groupname):
+        for job in reversed(self.jobs.values()):
+            if job.groupname == groupname:
+                return job
+        return None
+
+    def _trim(self):
+        finished = [job_id for (job_id, job) in self.jobs.items()
+                    if job.state in (DONE, FAILED)]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[job_id]
+
+    def _start_workers(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work,
+                                      name='apply-%d' % len(self._threads))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _next_job(self):
+        # called with the condition held, waits until a job can run
+        while True:
+            now = time.time()
+            ready = [job for job in self.pending.values()
+                     if job.groupname not in self.running]
+            waiting = [job.not_before - now for job in ready]
+            if ready and min(waiting) <= 0:
+                job = ready[waiting.index(min(waiting))]
+                del self.pending[job.groupname]
+                self.running.add(job.groupname)
+                return job
+            self._condition.wait(min(waiting) if waiting else None)
+
+    def _work(self):
+        while True:
+            with self._condition:
+                job = self._next_job()
+                job.state = RUNNING
+                job.started = datetime.now()
+
+            try:
+                job.apply('+'.join(job.usernames))
+            except BackendApplyChangesException, e:
+                (state, output) = (FAILED, e.message)
+            except Exception, e:
+                log.exception("Applying changes of %s", job.groupname)
+                (state, output) = (FAILED, repr(e))
+            else:
+                (state, output) = (DONE, '')
+
+            with self._condition:
+                job.state = state
+                job.output = output
+                job.finished = datetime.now()
+                self.running.discard(job.groupname)
+                self._trim()
+                self._condition.notify_all()
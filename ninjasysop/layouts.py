@@ -30,14 +30,25 @@
 from pyramid.renderers import get_renderer
 from pyramid.decorator import reify
 
+# templates loaded once per process, they still reload themselves when
+# pyramid.reload_templates is set
+_templates = {}
+
+
+def _template(name):
+    template = _templates.get(name)
+    if template is None:
+        template = _templates.setdefault(name,
+                                         get_renderer(name).implementation())
+    return template
+
+
 class Layouts(object):
 
         @reify
         def global_template(self):
-            renderer = get_renderer("templates/global_layout.pt")
-            return renderer.implementation()
+            return _template("templates/global_layout.pt")
 
         @reify
         def global_macros(self):
-            renderer = get_renderer("templates/macros.pt")
-            return renderer.implementation().macros
+            return _template("templates/macros.pt").macros
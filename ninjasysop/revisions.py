@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) <2012> Antonio Pérez-Aranda Alcaide (ant30) <ant30tx@gmail.com>
+#                      Antonio Pérez-Aranda Alcaide (Yaco Sistemas SL) <aperezaranda@yaco.es>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of copyright holders nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL COPYRIGHT HOLDERS OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Revisions of the group files kept by content.
+
+Every applied file is cut in chunks of lines whose boundaries depend on
+the content, so an edit only changes the chunks around it. Chunks are
+stored compressed once, named by their sha1, and a revision is the list
+of its chunks plus a line in the index of the store.
+"""
+import hashlib
+import os
+import threading
+import zlib
+from collections import namedtuple
+from datetime import datetime
+
+from backends import atomic_files
+
+STORE_DIR = '.revisions'
+# a chunk ends after a line whose crc matches the mask, 256 lines on average
+CHUNK_MASK = 0xff
+CHUNK_MIN_LINES = 16
+CHUNK_MAX_LINES = 4096
+TIMESTAMP_FORMAT = "%Y%m%d%H%M%S"
+
+Revision = namedtuple('Revision', ('serial', 'username', 'timestamp',
+                                   'manifest'))
+
+
+def split_chunks(content):
+    chunks = []
+    chunk = []
+    for line in content.splitlines(True):
+        chunk.append(line)
+        if len(chunk) >= CHUNK_MAX_LINES or (
+                len(chunk) >= CHUNK_MIN_LINES and
+                not zlib.crc32(line) & CHUNK_MASK):
+            chunks.append(''.join(chunk))
+            chunk = []
+    if chunk:
+        chunks.append(''.join(chunk))
+    return chunks
+
+
+class RevisionStore(object):
+    """Revisions of filename, in the .revisions directory next to it.
+
+    keep is the number of revisions kept, the older ones and the chunks
+    only they use are removed when a revision is saved. 0 keeps all.
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, filename, keep=0):
+        self.filename = filename
+        self.keep = keep
+        self.path = os.path.join(os.path.dirname(os.path.abspath(filename)),
+                                 STORE_DIR, os.path.basename(filename))
+        self.index_filename = os.path.join(self.path, 'index')
+
+    def _object_filename(self, digest):
+        return os.path.join(self.path, 'objects', digest[:2], digest[2:])
+
+    def _write_object(self, content):
+        digest = hashlib.sha1(content).hexdigest()
+        filename = self._object_filename(digest)
+        if not os.path.exists(filename):
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            atomic_files.write(filename, zlib.compress(content))
+        return digest
+
+    def _read_object(self, digest):
+        with open(self._object_filename(digest), 'rb') as objectfile:
+            return zlib.decompress(objectfile.read())
+
+    def save(self, serial, username):
+        """Stores the current content of the file as a new revision"""
+        with open(self.filename, 'r') as groupfile:
+            content = groupfile.read()
+
+        with self._lock:
+            digests = [self._write_object(chunk)
+                       for chunk in split_chunks(content)]
+            manifest = self._write_object('\n'.join(digests))
+            revision = Revision(str(serial), username,
+                                datetime.now().strftime(TIMESTAMP_FORMAT),
+                                manifest)
+            revisions = self._read_index()
+            revisions.append(revision)
+            if self.keep and len(revisions) > self.keep:
+                revisions = revisions[-self.keep:]
+                self._write_index(revisions)
+                self._collect(revisions)
+            else:
+                with open(self.index_filename, 'a') as index:
+                    index.write('\t'.join(revision) + '\n')
+        return revision
+
+    def _read_index(self):
+        try:
+            with open(self.index_filename, 'r') as index:
+                return [Revision(*line.rstrip('\n').split('\t'))
+                        for line in index if line.strip()]
+        except IOError:
+            return []
+
+    def _write_index(self, revisions):
+        atomic_files.write(self.index_filename,
+                           ''.join('\t'.join(revision) + '\n'
+                                   for revision in revisions))
+
+    def _collect(self, revisions):
+        # removes the objects no revision of the index refers to
+        used = set()
+        for revision in revisions:
+            used.add(revision.manifest)
+            used.update(self._read_object(revision.manifest).split('\n'))
+
+        objects = os.path.join(self.path, 'objects')
+        for prefix in os.listdir(objects):
+            for name in os.listdir(os.path.join(objects, prefix)):
+                if prefix + name not in used:
+                    os.remove(os.path.join(objects, prefix, name))
+
+    def list(self):
+        """Revisions from the oldest to the newest"""
+        return self._read_index()
+
+    def get(self, serial):
+        """Newest revision with serial, None if there is none"""
+        serial = str(serial)
+        for revision in reversed(self._read_index()):
+            if revision.serial == serial:
+                return revision
+        return None
+
+    def read(self, revision, current=None):
+        # chunks already in current are not read from the store
+        chunks = {}
+        if current is not None:
+            for chunk in split_chunks(current):
+                chunks[hashlib.sha1(chunk).hexdigest()] = chunk
+        digests = self._read_object(revision.manifest).split('\n')
+        return ''.join(chunks[digest] if digest in chunks
+                       else self._read_object(digest)
+                       for digest in digests if digest)
+
+    def restore(self, serial):
+        """Writes back the newest revision with serial into the file"""
+        revision = self.get(serial)
+        if revision is None:
+            raise KeyError("Revision %s not found" % serial)
+        with open(self.filename, 'r') as groupfile:
+            current = groupfile.read()
+        atomic_files.write(self.filename, self.read(revision, current))
+        return revision
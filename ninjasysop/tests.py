@@ -43,3 +43,1117 @@ class ViewTests(unittest.TestCase):
         request = testing.DummyRequest()
         info = my_view(request)
         self.assertEqual(info['project'], 'ninja-sysop')
+
+    def test_batch_requires_operations(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        from pyramid.request import Request
+        from .views import GroupRESTViews
+        self.config.add_settings(backend=None, backends={}, files={},
+                                 groups=None, protected_names={})
+        for body in ('not json', '{"op": "add"}', '["add"]',
+                     '[{"op": "add", "item": []}]'):
+            request = Request.blank('/', method='POST', body=body)
+            request.registry = self.config.registry
+            request.matchdict = {'groupname': 'lan'}
+            response = GroupRESTViews(request).batch()
+            self.assertTrue(isinstance(response, HTTPBadRequest))
+
+    def test_put_and_post_item(self):
+        import json
+        import os
+        import shutil
+        import tempfile
+        from pyramid.request import Request
+        from plugins.bind9.bind9 import Bind9
+        from .backends import BackendRegistry
+        from .views import ItemRESTView
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'db.example.com')
+        with open(filename, 'w') as f:
+            f.write(ZONE + "rr A 10.0.0.1\nrr A 10.0.0.2\n")
+        self.config.add_settings(
+            backend=Bind9, backends={}, files={'example.com': filename},
+            groups=BackendRegistry(Bind9, {'example.com': filename}),
+            protected_names={'example.com': []})
+
+        def call(method, itemname, values, query=''):
+            request = Request.blank('/' + query, method=method,
+                                    body=json.dumps(values),
+                                    content_type='application/json')
+            request.registry = self.config.registry
+            request.matchdict = {'groupname': 'example.com',
+                                 'itemname': itemname}
+            return (getattr(ItemRESTView(request), method.lower())(),
+                    request.response.status_int)
+
+        (item, status) = call('PUT', 'pop3', {'type': 'CNAME',
+                                              'target': 'mail'})
+        self.assertEqual((item['target'], status), ('mail', 201))
+        (errors, status) = call('PUT', 'smtp', {'type': 'A', 'target': 'x'})
+        self.assertEqual(status, 400)
+        (item, status) = call('POST', 'rr', {'target': '10.0.0.3'},
+                              '?target=10.0.0.2')
+        self.assertEqual((item['target'], status), ('10.0.0.3', 200))
+        zone = Bind9('example.com', filename)
+        self.assertEqual(sorted(r.target for r in
+                                zone.get_items(name_exact='rr')),
+                         ['10.0.0.1', '10.0.0.3'])
+
+
+class ParsedFileCacheTests(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def _makefile(self, name, content):
+        import os
+        filename = os.path.join(self.tmpdir, name)
+        with open(filename, 'w') as f:
+            f.write(content)
+        return filename
+
+    def test_unchanged_file_is_parsed_once(self):
+        from .backends import ParsedFileCache
+        cache = ParsedFileCache()
+        filename = self._makefile('zone', 'content')
+        calls = []
+        def parser():
+            calls.append(1)
+            return len(calls)
+        self.assertEqual(cache.get(filename, parser), 1)
+        self.assertEqual(cache.get(filename, parser), 1)
+        self.assertEqual(len(calls), 1)
+
+    def test_changed_file_is_parsed_again(self):
+        from .backends import ParsedFileCache
+        cache = ParsedFileCache()
+        filename = self._makefile('zone', 'content')
+        cache.get(filename, lambda: 'old')
+        self._makefile('zone', 'new content')
+        self.assertEqual(cache.get(filename, lambda: 'new'), 'new')
+
+    def test_lru_eviction(self):
+        from .backends import ParsedFileCache
+        cache = ParsedFileCache(max_size=10)
+        first = self._makefile('first', '12345')
+        second = self._makefile('second', '12345')
+        third = self._makefile('third', '12345')
+        cache.get(first, lambda: 1)
+        cache.get(second, lambda: 2)
+        cache.get(first, lambda: 1)
+        cache.get(third, lambda: 3)
+        self.assertTrue(first in cache)
+        self.assertFalse(second in cache)
+        self.assertTrue(third in cache)
+        self.assertEqual(cache.size, 10)
+
+    def test_groups_follow_the_cache(self):
+        from .backends import BackendRegistry, parsed_files
+        from plugins.bind9.bind9 import Bind9
+        parses = []
+
+        class Zone(Bind9):
+            def _readfile(self):
+                parses.append(self.name)
+                return super(Zone, self)._readfile()
+
+        files = dict((name, self._makefile(name, ZONE))
+                     for name in ('zone1', 'zone2'))
+        groups = BackendRegistry(Zone, files)
+        max_size = parsed_files.max_size
+        try:
+            for name in ['zone1', 'zone2'] * 5:
+                with groups.reading(name):
+                    pass
+            self.assertEqual(sorted(parses), ['zone1', 'zone2'])
+            # the group of the evicted file goes with it
+            parsed_files.resize(len(ZONE))
+            self.assertEqual(groups._groups.keys(), ['zone2'])
+        finally:
+            parsed_files.resize(max_size)
+
+
+ZONE = """$TTL    3600
+@       IN      SOA             ns1.example.com. admin.example.com (
+                2009092101      ;serial aaaammdd
+                10800           ;refresh. 3 hours
+                3600            ;retry. 1 hour
+                432000          ;expire. 5 days
+                86400 )         ;minimum. minium TTL (1 day)
+
+@       IN      NS              ns1.example.com.
+www   A 127.0.0.1
+mail    A 127.0.1.1
+imap    CNAME mail
+"""
+
+
+class ZoneFileTests(unittest.TestCase):
+    def setUp(self):
+        import os
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'db.example.com')
+        with open(self.filename, 'w') as f:
+            f.write(ZONE)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def _zonefile(self):
+        from plugins.bind9.bind9 import ZoneFile
+        zonefile = ZoneFile(self.filename)
+        (serial, items) = zonefile.readfile()
+        return zonefile, serial, items
+
+    def test_edits_keep_index(self):
+        from plugins.bind9.bind9 import Item
+        zonefile, serial, items = self._zonefile()
+        zonefile.remove_record(items.get('www'))
+        zonefile.save_record(items.get('imap'), Item('imap', 'A', '127.0.0.2'))
+        zonefile.add_record(Item('pop3', 'CNAME', 'mail'))
+        zonefile.remove_record(Item('imap', 'A', '127.0.0.2'))
+
+        zonefile, serial, items = self._zonefile()
+        self.assertEqual(sorted(items.names.keys()), ['@', 'mail', 'pop3'])
+
+    def test_save_serial(self):
+        zonefile, serial, items = self._zonefile()
+        zonefile.save_serial('2012010101')
+        zonefile, serial, items = self._zonefile()
+        self.assertEqual(serial, '2012010101')
+
+    def test_update_delta(self):
+        from plugins.bind9.bind9 import Item
+        from plugins.bind9.nsupdate import (update_script, zone_delta,
+                                            zone_records)
+        from .backends import run_command
+        old = zone_records(self.filename, 'example.com')
+        zonefile, serial, items = self._zonefile()
+        zonefile.remove_record(items.get('www'))
+        zonefile.save_record(items.get('imap'), Item('imap', 'CNAME', 'www'))
+        zonefile.save_serial('2012010101')
+
+        (deleted, added) = zone_delta(old, zone_records(self.filename,
+                                                        'example.com'))
+        script = update_script('example.com', deleted, added)
+        self.assertEqual(script.splitlines(), [
+            'zone example.com.',
+            'update delete imap.example.com. CNAME mail.example.com.',
+            'update delete www.example.com. A 127.0.0.1',
+            'update add example.com. 3600 SOA ns1.example.com. '
+            'admin.example.com.example.com. 2012010101 10800 3600 432000 '
+            '86400',
+            'update add imap.example.com. 3600 CNAME www.example.com.',
+            'send'])
+        self.assertEqual(run_command('cat', input=script), script)
+
+    def test_dynamic_apply(self):
+        import os
+        from plugins.bind9 import bind9
+        log = os.path.join(self.tmpdir, 'rndc.log')
+        # BIND writes the file of a dynamic zone in its own format
+        rndc = "echo %%s >> %s; echo dumped > %s #" % (log, self.filename)
+        saved = (bind9.FREEZE_COMMAND, bind9.THAW_COMMAND,
+                 bind9.SYNC_COMMAND, bind9.Bind9.update_command)
+        bind9.FREEZE_COMMAND = rndc % 'freeze'
+        bind9.THAW_COMMAND = "echo thaw >> %s #" % log
+        bind9.SYNC_COMMAND = rndc % 'sync'
+        bind9.Bind9.update_command = "grep 'update delete' >> %s" % log
+        try:
+            zone = bind9.Bind9('example.com', self.filename)
+            # the first apply has no base revision
+            zone.reload(zone.apply_changes('admin'))
+            zone.del_item('www')
+            zone.reload(zone.apply_changes('admin'))
+        finally:
+            (bind9.FREEZE_COMMAND, bind9.THAW_COMMAND,
+             bind9.SYNC_COMMAND, bind9.Bind9.update_command) = saved
+
+        with open(log) as f:
+            self.assertEqual(f.read().splitlines(), [
+                'freeze', 'thaw',
+                'update delete www.example.com. A 127.0.0.1', 'sync'])
+        with open(self.filename) as f:
+            content = f.read()
+        self.assertTrue('mail    A 127.0.1.1' in content)
+        self.assertFalse('www' in content)
+
+
+    def test_records_of_a_name(self):
+        import colander
+        from plugins.bind9.bind9 import Bind9
+        with open(self.filename, 'a') as f:
+            f.write("rr A 10.0.0.1\nrr A 10.0.0.2\n")
+        zone = Bind9('example.com', self.filename)
+        second = zone.get_item('rr', 'A', '10.0.0.2')
+        self.assertEqual(zone.item_selector(second),
+                         {'type': 'A', 'target': '10.0.0.2'})
+        zone.del_item('rr', **zone.item_selector(second))
+        self.assertEqual([r.target for r in zone.get_items(name_exact='rr')],
+                         ['10.0.0.1'])
+
+        # the name is checked as it is stored, relative to the zone
+        schema = zone.get_add_schema()
+        self.assertRaises(colander.Invalid, schema.deserialize,
+                          {'name': 'www.example.com', 'type': 'CNAME',
+                           'target': 'mail'})
+    def test_failed_write_keeps_file_content(self):
+        from plugins.bind9.bind9 import Bind9
+        from .backends import atomic_files
+        zone = Bind9('example.com', self.filename)
+
+        def replace(filename, content):
+            raise IOError("No space left on device")
+        atomic_files._replace = replace
+        try:
+            self.assertRaises(IOError, zone.del_item, 'www')
+        finally:
+            del atomic_files._replace
+
+        self.assertEqual(zone.get_item('www').target, '127.0.0.1')
+        # the next edit does not carry the failed one
+        zone.add_item({'name': 'pop3', 'type': 'CNAME', 'target': 'mail',
+                       'comment': '', 'ttl': 0})
+        with open(self.filename) as f:
+            content = f.read()
+        self.assertTrue('www' in content and 'pop3' in content)
+
+
+class AtomicWriterTests(unittest.TestCase):
+    def setUp(self):
+        import os
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'vlan1.conf')
+        with open(self.filename, 'w') as f:
+            f.write('old')
+        os.chmod(self.filename, 0640)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def test_replace_keeps_mode(self):
+        import os
+        from .backends import AtomicWriter
+        AtomicWriter().write(self.filename, 'new')
+        self.assertEqual(open(self.filename).read(), 'new')
+        self.assertEqual(os.stat(self.filename).st_mode & 0777, 0640)
+        self.assertEqual(os.listdir(self.tmpdir), ['vlan1.conf'])
+
+    def test_concurrent_writes_store_last_content(self):
+        import threading
+        from .backends import AtomicWriter
+        writer = AtomicWriter()
+        threads = [threading.Thread(target=writer.write,
+                                    args=(self.filename, 'x' * n))
+                   for n in range(1, 21)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(open(self.filename).read().startswith('x'))
+        # nothing is kept of the files written
+        self.assertEqual(writer._pending, {})
+
+
+class ZoneParserTests(unittest.TestCase):
+    def _parse(self, content, origin='example.com.'):
+        from plugins.bind9.zoneparser import parse_zone
+        return list(parse_zone(content.splitlines(True), origin))
+
+    def test_multiline_soa(self):
+        records = self._parse(ZONE)
+        soa = records[0]
+        self.assertEqual((soa.type, soa.start, soa.end), ('SOA', 1, 6))
+        self.assertEqual(soa.rdata[2], '2009092101')
+        self.assertEqual(soa.comment, 'serial aaaammdd')
+        self.assertEqual(soa.default_ttl, 3600)
+
+    def test_owner_ttl_class_and_origin(self):
+        records = self._parse("www 1h IN A 10.0.0.1\n"
+                              "    IN 300 AAAA ::1\n"
+                              "$ORIGIN sub.example.com.\n"
+                              "@ MX 10 mail\n"
+                              'txt TXT "a ; b" ; comment\n')
+        self.assertEqual([(r.name, r.ttl, r.type) for r in records],
+                         [('www.example.com.', 3600, 'A'),
+                          ('www.example.com.', 300, 'AAAA'),
+                          ('sub.example.com.', None, 'MX'),
+                          ('txt.sub.example.com.', None, 'TXT')])
+        self.assertEqual(records[2].rdata, ['10', 'mail'])
+        self.assertEqual(records[3].rdata, ['"a ; b"'])
+        self.assertEqual(records[3].comment, 'comment')
+
+    def test_unbalanced_parentheses(self):
+        from plugins.bind9.zoneparser import ZoneSyntaxError
+        self.assertRaises(ZoneSyntaxError, self._parse, "@ SOA ns1 admin (\n")
+
+
+class RecordStoreTests(unittest.TestCase):
+    def test_rrsets_keep_every_record(self):
+        from plugins.bind9.bind9 import Item, RecordStore
+        store = RecordStore()
+        store.add(Item('www', 'A', '10.0.0.1'))
+        store.add(Item('www', 'A', '10.0.0.2'))
+        store.add(Item('@', 'NS', 'ns1'))
+        store.add(Item('@', 'A', '10.0.0.1'))
+        self.assertEqual(len(store), 4)
+        self.assertEqual(sorted(r.target for r in store.rrset('www', 'A')),
+                         ['10.0.0.1', '10.0.0.2'])
+        self.assertEqual(sorted(store.rrsets('@').keys()), ['A', 'NS'])
+
+        store.remove(store.get('www', 'A', '10.0.0.1'))
+        self.assertEqual([r.target for r in store.rrset('www', 'A')],
+                         ['10.0.0.2'])
+        store.remove(store.get('www'))
+        self.assertFalse('www' in store)
+        self.assertEqual(len(store), 2)
+
+
+class ItemIndexTests(unittest.TestCase):
+    def _item(self, name, ip, mac):
+        class Host(object):
+            pass
+        host = Host()
+        (host.name, host.ip, host.mac) = (name, ip, mac)
+        return host
+
+    def test_filters_and_search(self):
+        from .backends import IndexedItems
+        items = IndexedItems(('ip', 'mac'),
+                             normalize={'mac': lambda mac: mac.lower()})
+        items['www'] = self._item('www', '10.0.0.1', 'AA:00:00:00:00:01')
+        items['www2'] = self._item('www2', '10.0.0.2', 'aa:00:00:00:00:02')
+        items['mail'] = self._item('mail', '10.0.0.2', 'aa:00:00:00:00:03')
+
+        self.assertEqual([i.name for i in items.filter(mac='aa:00:00:00:00:01')],
+                         ['www'])
+        self.assertEqual(sorted(i.name for i in items.filter(ip='10.0.0.2')),
+                         ['mail', 'www2'])
+        self.assertEqual(sorted(i.name for i in items.filter(name='ww')),
+                         ['www', 'www2'])
+        self.assertEqual(sorted(i.name for i in items.filter(name='www')),
+                         ['www', 'www2'])
+        self.assertEqual([i.name for i in items.filter(name='ww2',
+                                                       ip='10.0.0.2')],
+                         ['www2'])
+
+        del items['www2']
+        items['mail'] = self._item('mail', '10.0.0.3', 'aa:00:00:00:00:03')
+        self.assertEqual([i.name for i in items.filter(name='www')], ['www'])
+        self.assertEqual(items.filter(ip='10.0.0.2'), [])
+        self.assertEqual(len(items.filter()), 2)
+
+    def test_pages(self):
+        from .backends import IndexedItems
+        items = IndexedItems(('ip', 'mac'))
+        for n in (5, 3, 1, 4, 2):
+            items['host%d' % n] = self._item('host%d' % n, '10.0.0.%d' % n,
+                                             'aa:00:00:00:00:0%d' % n)
+
+        page = items.filter(order='name', offset=1, limit=2)
+        self.assertEqual([i.name for i in page], ['host2', 'host3'])
+        self.assertEqual(page.total, 5)
+        del items['host2']
+        items['host0'] = self._item('host0', '10.0.0.9', 'aa:00:00:00:00:09')
+        self.assertEqual([i.name for i in items.filter(order='name', limit=3)],
+                         ['host0', 'host1', 'host3'])
+        self.assertEqual([i.name for i in items.filter(order='-name', offset=1,
+                                                       limit=2)],
+                         ['host4', 'host3'])
+        page = items.filter(name='host', order='-ip', offset=4)
+        self.assertEqual(([i.name for i in page], page.total), (['host1'], 5))
+
+
+class ApplyQueueTests(unittest.TestCase):
+    def test_coalesces_group_applies(self):
+        import threading
+        import time
+        from .jobs import ApplyQueue, DONE, FAILED
+        from .backends import BackendApplyChangesException
+        calls = []
+        applied = threading.Event()
+
+        def apply(username):
+            calls.append(username)
+            applied.set()
+
+        def broken(username):
+            raise BackendApplyChangesException('rndc failed')
+
+        queue = ApplyQueue(delay=0.2, max_delay=5, workers=1)
+        first = queue.submit('example.com', 'alice', apply)
+        second = queue.submit('example.com', 'bob', apply)
+        self.assertTrue(first is second)
+        self.assertTrue(applied.wait(5))
+
+        failed = queue.submit('other.com', 'alice', broken)
+        for i in range(50):
+            if failed.state == FAILED:
+                break
+            time.sleep(0.1)
+        self.assertEqual(calls, ['alice+bob'])
+        self.assertEqual(first.state, DONE)
+        self.assertEqual(failed.output, 'rndc failed')
+        self.assertTrue(queue.last('example.com') is first)
+        self.assertEqual(queue.get(failed.id).todict()['state'], FAILED)
+
+
+class BackendRegistryTests(unittest.TestCase):
+    def test_shared_locked_backends(self):
+        import threading
+        import time
+        from .backends import Backend, BackendRegistry
+        events = []
+
+        class Counter(Backend):
+            refreshes = 0
+
+            def refresh(self):
+                self.refreshes += 1
+
+        groups = BackendRegistry(Counter, {'example.com': '/dev/null'})
+        with groups.writing('example.com') as group:
+            # the writer may read its own changes
+            with groups.reading('example.com') as same:
+                self.assertTrue(same is group)
+
+            def read():
+                with groups.reading('example.com'):
+                    events.append('read')
+            reader = threading.Thread(target=read)
+            reader.start()
+            time.sleep(0.1)
+            events.append('write')
+        reader.join(5)
+        self.assertEqual(events, ['write', 'read'])
+        self.assertEqual(group.refreshes, 3)
+
+    def test_readers_share_the_group(self):
+        import threading
+        from .backends import Backend, BackendRegistry, parsed_files
+
+        class Zone(Backend):
+            def refresh(self):
+                self.stamp = parsed_files.stamp(self.filename)
+
+        groups = BackendRegistry(Zone, {'example.com': '/dev/null'})
+        inside = threading.Event()
+        with groups.reading('example.com'):
+            def read():
+                with groups.reading('example.com'):
+                    inside.set()
+            reader = threading.Thread(target=read)
+            reader.start()
+            inside.wait(5)
+            self.assertTrue(inside.is_set())
+        reader.join(5)
+
+    def test_reload_without_the_lock(self):
+        import threading
+        from .backends import Backend, BackendRegistry
+        from .views import group_applier
+        events = []
+
+        class Zone(Backend):
+            def apply_changes(self, username):
+                return 'r1'
+
+            def reload(self, revision):
+                # the group is read while the service reloads
+                done = threading.Event()
+                def read():
+                    with groups.reading('example.com'):
+                        done.set()
+                threading.Thread(target=read).start()
+                events.append((revision, done.wait(5)))
+
+        groups = BackendRegistry(Zone, {'example.com': '/dev/null'})
+        group_applier(groups, 'example.com')('admin')
+        self.assertEqual(events, [('r1', True)])
+
+    def test_warm_up(self):
+        from .backends import Backend, BackendRegistry
+
+        class Zone(Backend):
+            def __init__(self, name, filename):
+                if filename is None:
+                    raise IOError('No such file')
+                super(Zone, self).__init__(name, filename)
+
+        files = dict(('zone%d' % n, '/dev/null') for n in range(20))
+        files['broken'] = None
+        groups = BackendRegistry(Zone, files)
+        self.assertEqual(groups.warm_up(4), ['broken'])
+        self.assertEqual(len(groups._groups), 20)
+
+    def test_several_backends(self):
+        from . import parse_files, get_files
+        from .backends import Backend, BackendRegistry
+        settings = {'ninjasysop.backend': 'bind9',
+                    'ninjasysop.files': '\nexample.com:/dev/null\n'
+                                        'vlan1:dhcpd:/dev/null'}
+        self.assertEqual(parse_files(settings),
+                         [('example.com', 'bind9', '/dev/null'),
+                          ('vlan1', 'dhcpd', '/dev/null')])
+        self.assertEqual(get_files(settings, 'dhcpd'), {'vlan1': '/dev/null'})
+
+        class Zone(Backend):
+            pass
+
+        class Network(Backend):
+            pass
+
+        groups = BackendRegistry(Zone, get_files(settings),
+                                 {'vlan1': Network})
+        self.assertTrue(isinstance(groups.get('example.com'), Zone))
+        self.assertTrue(isinstance(groups.get('vlan1'), Network))
+
+
+class StreamTests(unittest.TestCase):
+    def test_stream_entries(self):
+        import json
+        from plugins.dhcpd.dhcpd import DhcpHost
+        from plugins.dhcpd.forms import HostSchema
+        from . import views
+        fields = [node['name'] for node in views.schema_definition(HostSchema)]
+        self.assertTrue(views.schema_definition(HostSchema) is
+                        views._schema_definitions[HostSchema])
+
+        entries = [(DhcpHost('host%d' % n, 'aa:00:00:00:00:%02d' % n,
+                             '10.0.0.%d' % n), n == 1)
+                   for n in range(1, views.STREAM_CHUNK + 2)]
+        chunks = list(views.stream_entries(fields, entries))
+        self.assertEqual(len(chunks), 2)
+        listing = json.loads(''.join(chunks))
+        self.assertEqual(len(listing), len(entries))
+        self.assertEqual(listing[0], {'item': {'name': 'host1',
+                                               'ip': '10.0.0.1',
+                                               'mac': 'aa:00:00:00:00:01'},
+                                      'protected': True})
+        lines = ''.join(views.stream_entries(fields, entries[:3], True))
+        self.assertEqual([json.loads(line)['item']['name']
+                          for line in lines.splitlines()],
+                         ['host1', 'host2', 'host3'])
+        self.assertEqual(''.join(views.stream_entries(fields, [])), '[]')
+
+
+class ConditionalTests(unittest.TestCase):
+    def test_validators(self):
+        import os
+        import tempfile
+        from webob import Request
+        from .views import conditional
+        (fd, filename) = tempfile.mkstemp()
+        os.write(fd, 'www A 127.0.0.1\n')
+        os.close(fd)
+        self.addCleanup(os.unlink, filename)
+
+        (headers, fresh) = conditional(Request.blank('/'), [filename])
+        self.assertFalse(fresh)
+        etag = headers['ETag']
+        request = Request.blank('/', headers={'If-None-Match': etag})
+        self.assertTrue(conditional(request, [filename])[1])
+        self.assertFalse(conditional(request, [filename], 'bob')[1])
+        request = Request.blank('/', headers={
+            'If-Modified-Since': headers['Last-Modified']})
+        self.assertTrue(conditional(request, [filename])[1])
+
+        with open(filename, 'a') as f:
+            f.write('mail A 127.0.0.2\n')
+        request = Request.blank('/', headers={'If-None-Match': etag})
+        self.assertFalse(conditional(request, [filename])[1])
+
+
+class UserDBTests(unittest.TestCase):
+    def test_verified_credentials(self):
+        import os
+        import tempfile
+        import time
+        from passlib.apache import HtpasswdFile
+        from .userdb import UserDB
+        (fd, filename) = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, filename)
+        htpasswd = HtpasswdFile(filename)
+        htpasswd.set_password('alice', 'secret')
+        htpasswd.save()
+
+        userdb = UserDB(filename)
+        self.assertTrue(userdb.check_password('alice', 'secret'))
+        self.assertFalse(userdb.check_password('alice', 'wrong'))
+        self.assertEqual(len(userdb._verified), 1)
+        self.assertFalse('secret' in repr(userdb._verified))
+
+        calls = []
+        check = userdb.htpasswd.check_password
+
+        def counted(*args):
+            calls.append(args)
+            return check(*args)
+        userdb.htpasswd.check_password = counted
+        self.assertTrue(userdb.check_password('alice', 'secret'))
+        self.assertEqual(calls, [])
+
+        # a new password drops what was verified
+        htpasswd.set_password('alice', 'other')
+        htpasswd.save()
+        later = time.time() + 10
+        os.utime(filename, (later, later))
+        self.assertFalse(userdb.check_password('alice', 'secret'))
+        self.assertTrue(userdb.check_password('alice', 'other'))
+
+
+class RevisionStoreTests(unittest.TestCase):
+    def setUp(self):
+        import os
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'db.example.com')
+        self.lines = ['host%d A 10.0.%d.%d\n' % (i, i / 256, i % 256)
+                      for i in range(5000)]
+        self._write()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self):
+        with open(self.filename, 'w') as f:
+            f.write(''.join(self.lines))
+
+    def _objects(self, store):
+        import os
+        return sum(len(files) for (path, dirs, files)
+                   in os.walk(os.path.join(store.path, 'objects')))
+
+    def test_save_and_restore(self):
+        from .revisions import RevisionStore
+        store = RevisionStore(self.filename)
+        store.save('1', 'alice')
+        first = self._objects(store)
+        self.lines[2500] = 'changed A 10.1.0.1\n'
+        self._write()
+        store.save('2', 'bob')
+        # the manifest and the few chunks around the change
+        self.assertTrue(self._objects(store) - first <= 3)
+
+        self.assertEqual([(r.serial, r.username) for r in store.list()],
+                         [('1', 'alice'), ('2', 'bob')])
+        store.restore('1')
+        with open(self.filename) as f:
+            self.assertEqual(f.read().splitlines()[2500], 'host2500 A 10.0.9.196')
+        self.assertRaises(KeyError, store.restore, '3')
+
+    def test_keep(self):
+        from .revisions import RevisionStore
+        store = RevisionStore(self.filename, keep=2)
+        for serial in range(4):
+            self.lines[0] = 'host0 A 10.2.0.%d\n' % serial
+            self._write()
+            store.save(serial, 'alice')
+        self.assertEqual([r.serial for r in store.list()], ['2', '3'])
+        store.restore('2')
+        with open(self.filename) as f:
+            self.assertEqual(f.readline(), 'host0 A 10.2.0.2\n')
+
+
+class IPAllocatorTests(unittest.TestCase):
+    def test_free_addresses(self):
+        from ipaddr import IPv4Network
+        from plugins.dhcpd.allocator import IPAllocator
+        allocator = IPAllocator(IPv4Network('10.0.0.0/24'),
+                                ranges=[('10.0.0.100', '10.0.0.250')],
+                                reserved=['10.0.0.1'])
+        allocator.use('10.0.0.2')
+        allocator.use('10.1.0.3')
+        self.assertEqual(allocator.next_free(), '10.0.0.3')
+        for ip in ('10.0.0.3', '10.0.0.4', '10.0.0.5'):
+            allocator.use(ip)
+        allocator.release('10.0.0.2')
+        self.assertEqual(allocator.next_free(), '10.0.0.2')
+        self.assertFalse(allocator.is_free('10.0.0.120'))
+        self.assertEqual(allocator.free_count(), 99)
+        used = []
+        while allocator.next_free():
+            used.append(allocator.next_free())
+            allocator.use(used[-1])
+        self.assertEqual(used[-5:], ['10.0.0.99', '10.0.0.251', '10.0.0.252',
+                                     '10.0.0.253', '10.0.0.254'])
+        self.assertEqual(allocator.next_free(), None)
+
+
+DHCPD_CONF = """shared-network lan {
+  subnet 10.0.0.0 netmask 255.255.255.0 {
+    range 10.0.0.100 10.0.0.200;
+    option routers 10.0.0.1;
+  }
+  subnet 10.0.1.0 netmask 255.255.255.0 {
+    option domain-name "lan; {1}";
+    pool { range dynamic-bootp 10.0.1.2 10.0.1.50; }
+  }
+}
+group {
+  # printer
+  host printer {
+    hardware ethernet 00:11:22:33:44:55;
+    fixed-address 10.0.0.2;
+  }
+}
+host pc { hardware ethernet 00:11:22:33:44:56; fixed-address 10.0.1.60; }
+"""
+
+
+class ConfParserTests(unittest.TestCase):
+    def test_blocks(self):
+        from plugins.dhcpd.confparser import parse_conf
+        conf = parse_conf(DHCPD_CONF)
+        subnets = list(conf.find('subnet'))
+        self.assertEqual([subnet.args[0] for subnet in subnets],
+                         ['10.0.0.0', '10.0.1.0'])
+        self.assertEqual(subnets[1].option('option', 'domain-name'),
+                         ['"lan; {1}"'])
+        self.assertEqual(list(subnets[1].find('pool'))[0].option('range'),
+                         ['dynamic-bootp', '10.0.1.2', '10.0.1.50'])
+
+        (printer, pc) = conf.find('host')
+        self.assertEqual(printer.comment, 'printer')
+        self.assertEqual(printer.option('fixed-address'), ['10.0.0.2'])
+        self.assertTrue(DHCPD_CONF[printer.comment_start:printer.end]
+                        .startswith('# printer\n  host printer {'))
+        self.assertEqual(DHCPD_CONF[pc.start:pc.end],
+                         'host pc { hardware ethernet 00:11:22:33:44:56; '
+                         'fixed-address 10.0.1.60; }')
+
+    def test_syntax_errors(self):
+        from plugins.dhcpd.confparser import parse_conf, DhcpdSyntaxError
+        self.assertRaises(DhcpdSyntaxError, parse_conf, 'group {\n')
+        self.assertRaises(DhcpdSyntaxError, parse_conf, 'host a { }\n}')
+        self.assertRaises(DhcpdSyntaxError, parse_conf, 'option a')
+
+    def test_dhcpd_subnets(self):
+        import os
+        import tempfile
+        from plugins.dhcpd.dhcpd import Dhcpd
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'lan.conf')
+            with open(filename, 'w') as f:
+                f.write(DHCPD_CONF)
+            dhcpd = Dhcpd('lan', filename)
+            self.assertEqual(sorted(dhcpd.items), ['pc', 'printer'])
+            self.assertEqual(dhcpd.get_free_ip(), '10.0.0.3')
+            subnet = dhcpd.get_subnet('10.0.1.60')
+            self.assertEqual(subnet['ranges'][0][1].exploded, '10.0.1.50')
+            self.assertEqual(dhcpd.get_subnet('10.0.2.1'), None)
+        finally:
+            import shutil
+            shutil.rmtree(tmpdir)
+
+
+class NetworkFileTests(unittest.TestCase):
+    def setUp(self):
+        import os
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'lan.conf')
+        with open(self.filename, 'w') as f:
+            f.write(DHCPD_CONF)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def test_edits_splice_hosts(self):
+        from plugins.dhcpd.dhcpd import Dhcpd
+        dhcpd = Dhcpd('lan', self.filename)
+        dhcpd.save_item(dhcpd.get_item('printer'),
+                        dict(name='printer2', mac='00:11:22:33:44:57',
+                             ip='10.0.0.3'))
+        dhcpd.del_item('pc')
+        dhcpd.add_item(dict(name='pc.2', mac='00:11:22:33:44:58',
+                            ip='10.0.0.4'))
+        dhcpd.save_item(dhcpd.get_item('pc.2'),
+                        dict(name='pc.2', mac='00:11:22:33:44:58',
+                             ip='10.0.0.5'))
+
+        with open(self.filename) as f:
+            content = f.read()
+        self.assertTrue('  #printer\nhost printer2 {\n' in content)
+        self.assertFalse('host pc {' in content)
+        self.assertTrue(content.endswith('}\n}\nhost pc.2 {\n'
+                                         ' hardware ethernet 00:11:22:33:44:58;\n'
+                                         ' fixed-address 10.0.0.5;\n}\n'))
+
+        from ninjasysop.backends import parsed_files
+        parsed_files.clear()
+        dhcpd = Dhcpd('lan', self.filename)
+        self.assertEqual(sorted(dhcpd.items), ['pc.2', 'printer2'])
+        self.assertEqual(dhcpd.get_item('printer2').comment, 'printer')
+
+    def test_edit_under_comment_lines(self):
+        from ninjasysop.backends import parsed_files
+        from plugins.dhcpd.dhcpd import Dhcpd
+        with open(self.filename, 'a') as f:
+            f.write("# rack 4\n# owner: ops\n"
+                    "host scanner { hardware ethernet 00:11:22:33:44:57;"
+                    " fixed-address 10.0.0.3; }\n")
+        dhcpd = Dhcpd('lan', self.filename)
+        dhcpd.save_item(dhcpd.get_item('scanner'),
+                        dict(name='scanner', mac='00:11:22:33:44:57',
+                             ip='10.0.0.4'))
+
+        with open(self.filename) as f:
+            self.assertTrue('#rack 4\n#owner: ops\nhost scanner {'
+                            in f.read())
+        parsed_files.clear()
+        dhcpd = Dhcpd('lan', self.filename)
+        self.assertEqual(dhcpd.get_item('scanner').ip, '10.0.0.4')
+        self.assertEqual(dhcpd.get_item('scanner').comment,
+                         'rack 4\nowner: ops')
+
+    def test_validator_duplicates(self):
+        import colander
+        from plugins.dhcpd.dhcpd import Dhcpd
+        dhcpd = Dhcpd('lan', self.filename)
+        host = dict(name='scanner', mac='00:11:22:33:44:AA', ip='10.0.0.9')
+        self.assertEqual(dhcpd.get_add_schema().deserialize(host), host)
+
+        for (field, value) in (('ip', '10.0.1.60'),
+                               ('ip', '10.0.0.150'),
+                               ('mac', '00:11:22:33:44:55')):
+            duplicate = dict(host, **{field: value})
+            self.assertRaises(colander.Invalid,
+                              dhcpd.get_add_schema().deserialize, duplicate)
+
+        printer = dict(name='printer', mac='00:11:22:33:44:55',
+                       ip='10.0.0.2')
+        schema = dhcpd.get_edit_schema('printer')
+        self.assertEqual(schema.deserialize(printer), printer)
+        self.assertRaises(colander.Invalid, schema.deserialize,
+                          dict(printer, mac='00:11:22:33:44:56'))
+
+    def test_bound_schemas(self):
+        import deform
+        from plugins.dhcpd.dhcpd import Dhcpd
+        dhcpd = Dhcpd('lan', self.filename)
+        add = dhcpd.get_add_schema()
+        edit = dhcpd.get_edit_schema('printer')
+        self.assertEqual(add['ip'].default, dhcpd.get_free_ip())
+        self.assertTrue(isinstance(add['name'].widget,
+                                   deform.widget.TextInputWidget))
+        self.assertTrue(isinstance(edit['name'].widget,
+                                   deform.widget.HiddenWidget))
+        self.assertTrue(edit['mac'] is add['mac'])
+        self.assertFalse(edit['ip'] is add['ip'])
+        self.assertTrue(edit.validator.old is dhcpd.get_item('printer'))
+
+    def test_batch(self):
+        import os
+        from plugins.dhcpd.dhcpd import Dhcpd
+        dhcpd = Dhcpd('lan', self.filename)
+        stamp = os.stat(self.filename).st_ino
+        try:
+            with dhcpd.batch():
+                dhcpd.del_item('pc')
+                dhcpd.add_item(dict(name='pc2', mac='00:11:22:33:44:58',
+                                    ip='10.0.0.4'))
+                self.assertEqual(os.stat(self.filename).st_ino, stamp)
+                raise ValueError('invalid')
+        except ValueError:
+            pass
+        self.assertEqual(sorted(dhcpd.items), ['pc', 'printer'])
+        with open(self.filename) as f:
+            self.assertEqual(f.read(), DHCPD_CONF)
+
+        with dhcpd.batch():
+            dhcpd.del_item('pc')
+            dhcpd.add_item(dict(name='pc2', mac='00:11:22:33:44:58',
+                                ip='10.0.0.4'))
+            self.assertEqual(os.stat(self.filename).st_ino, stamp)
+        with open(self.filename) as f:
+            content = f.read()
+        self.assertTrue('host pc2 {' in content)
+        self.assertFalse('host pc {' in content)
+        self.assertTrue(Dhcpd('lan', self.filename).get_item('pc2'))
+
+
+class NetworksTests(unittest.TestCase):
+    def test_prefix_tree(self):
+        from ipaddr import IPv4Network
+        from plugins.dhcpd.networks import PrefixTree
+        tree = PrefixTree()
+        tree.insert(IPv4Network('10.0.0.0/8'), 'core')
+        tree.insert(IPv4Network('10.4.0.0/16'), 'vlan4')
+        self.assertEqual(tree.lookup('10.4.7.9')[1], 'vlan4')
+        self.assertEqual(tree.lookup('10.5.7.9')[1], 'core')
+        self.assertEqual(tree.lookup('192.168.0.1'), (None, None))
+        tree.remove(IPv4Network('10.4.0.0/16'), 'vlan4')
+        self.assertEqual(tree.lookup('10.4.7.9')[1], 'core')
+
+    def test_groups(self):
+        import os
+        import shutil
+        import tempfile
+        from plugins.dhcpd.networks import Networks
+        tmpdir = tempfile.mkdtemp()
+        try:
+            files = {}
+            for (group, subnet) in (('vlan1', '10.0.0.0'),
+                                    ('vlan2', '10.0.1.0')):
+                files[group] = os.path.join(tmpdir, group)
+                with open(files[group], 'w') as f:
+                    f.write("subnet %s netmask 255.255.255.0 { }\n"
+                            "host pc { hardware ethernet 00:11:22:33:44:55;"
+                            " fixed-address 10.0.0.7; }\n" % subnet)
+            networks = Networks()
+            networks.configure(files)
+            self.assertEqual(networks.group_of('10.0.1.3')[0], 'vlan2')
+            self.assertEqual(networks.group_of('10.0.2.3'), (None, None))
+            self.assertEqual(networks.hosts_with_mac('00:11:22:33:44:55'),
+                             [('vlan1', 'pc'), ('vlan2', 'pc')])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+LEASE = """lease %s {
+  starts 4 2012/01/26 10:00:00;
+  ends %s;
+  binding state %s;
+  hardware ethernet 00:11:22:33:44:%02x;
+  client-hostname "pc%d";
+}
+"""
+
+
+class LeaseFileTests(unittest.TestCase):
+    def setUp(self):
+        import os
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'dhcpd.leases')
+        with open(self.filename, 'w') as f:
+            f.write('# dhcpd leases\n')
+            f.write(LEASE % ('10.0.0.3', 'never', 'active', 3, 3))
+            f.write(LEASE % ('10.0.0.4', '4 2012/01/26 11:00:00', 'active',
+                             4, 4))
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def test_incremental_reads(self):
+        import os
+        from plugins.dhcpd.leases import LeaseFile
+        leases = LeaseFile(self.filename)
+        self.assertEqual(sorted(leases.active()), ['10.0.0.3'])
+        self.assertEqual(leases.leases['10.0.0.4'].hostname, 'pc4')
+
+        lease = LEASE % ('10.0.0.3', 'never', 'free', 3, 3)
+        with open(self.filename, 'a') as f:
+            f.write(LEASE % ('10.0.0.5', 'never', 'active', 5, 5))
+            f.write(lease[:30])
+        offset = leases.offset
+        self.assertEqual(sorted(leases.active()), ['10.0.0.3', '10.0.0.5'])
+        self.assertTrue(leases.offset > offset)
+        with open(self.filename, 'a') as f:
+            f.write(lease[30:])
+        self.assertEqual(sorted(leases.active()), ['10.0.0.5'])
+
+        # dhcpd writes a new file from time to time
+        with open(self.filename + '~', 'w') as f:
+            f.write(LEASE % ('10.0.0.6', 'never', 'active', 6, 6))
+        os.rename(self.filename + '~', self.filename)
+        self.assertEqual(sorted(leases.active()), ['10.0.0.6'])
+
+    def test_free_ip_skips_leases(self):
+        import os
+        from plugins.dhcpd.dhcpd import Dhcpd
+        from plugins.dhcpd.leases import LeaseFile
+        filename = os.path.join(self.tmpdir, 'lan.conf')
+        with open(filename, 'w') as f:
+            f.write(DHCPD_CONF)
+        Dhcpd.leases = LeaseFile(self.filename)
+        try:
+            dhcpd = Dhcpd('lan', filename)
+            self.assertEqual(dhcpd.get_free_ip(), '10.0.0.4')
+            self.assertEqual(dhcpd.get_stats()[0],
+                             ('10.0.0.0/24', '1 hosts, 1 leases, 150 free'))
+            dhcpd.del_item('printer')
+            self.assertEqual(dhcpd.get_stats()[0],
+                             ('10.0.0.0/24', '0 hosts, 1 leases, 151 free'))
+        finally:
+            Dhcpd.leases = None
+
+    def test_source_state_follows_expiry(self):
+        import calendar
+        import time
+        from plugins.dhcpd.dhcpd import Dhcpd
+        from plugins.dhcpd.leases import LeaseFile
+        with open(self.filename, 'a') as f:
+            f.write(LEASE % ('10.0.0.5', '2 2030/01/01 00:00:00', 'active',
+                             5, 5))
+        ends = calendar.timegm((2030, 1, 1, 0, 0, 0))
+        Dhcpd.leases = LeaseFile(self.filename)
+        saved = time.time
+        try:
+            self.assertEqual(Dhcpd.source_state(), (ends,))
+            # the ETag of the group page changes with no write to the file
+            time.time = lambda: ends + 1
+            self.assertEqual(Dhcpd.source_state(), (None,))
+        finally:
+            time.time = saved
+            Dhcpd.leases = None
+
+
+class ImportTests(unittest.TestCase):
+    def setUp(self):
+        import os
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'lan.conf')
+        with open(self.filename, 'w') as f:
+            f.write(DHCPD_CONF)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def test_validate_and_add(self):
+        from plugins.dhcpd.dhcpd import Dhcpd
+        dhcpd = Dhcpd('lan', self.filename)
+        rows = [dict(name='node%d' % i, ip='10.0.0.%d' % (10 + i),
+                     mac='00:00:00:00:01:%02x' % i) for i in range(50)]
+        bad = [dict(name='node0', ip='10.0.0.10', mac='00:00:00:00:01:00'),
+               dict(name='pc2', ip='10.9.0.1', mac='00:11:22:33:44:55'),
+               dict(name='pc3', ip='10.0.0', mac='00:00:00:00:02:00'),
+               dict(name='pc4', ip='10.0.0.150', mac='00:00:00:00:02:01')]
+
+        (values, errors) = dhcpd.validate_items(rows + bad)
+        self.assertEqual(errors, [(50, 'name', "Repeated in the import"),
+                                  (50, 'ip', "Repeated in the import"),
+                                  (50, 'mac', "Repeated in the import"),
+                                  (51, 'ip', "10.9.0.1 is not in the subnets"),
+                                  (51, 'mac', "MAC is already assigned to "
+                                              "host printer"),
+                                  (52, 'ip', "10.0.0 is not a valid IP"),
+                                  (53, 'ip', "IP is in a dynamic range, "
+                                             "reserved or leased")])
+
+        (values, errors) = dhcpd.validate_items(rows)
+        self.assertEqual(errors, [])
+        dhcpd.add_items(values)
+
+        from ninjasysop.backends import parsed_files
+        parsed_files.clear()
+        dhcpd = Dhcpd('lan', self.filename)
+        self.assertEqual(len(dhcpd.items), 52)
+        self.assertEqual(dhcpd.get_item('node49').ip, '10.0.0.59')
@@ -27,16 +27,137 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 # 
+import hashlib
+import hmac
+import os
+import threading
+import time
+
 from passlib.apache import HtpasswdFile
+from pyramid.authentication import (AuthTktAuthenticationPolicy,
+                                    BasicAuthAuthenticationPolicy)
+
+# seconds a verified user and password are trusted without hashing them
+DEFAULT_CREDENTIALS_TTL = 60
+MAX_CREDENTIALS = 4096
 
 
 class UserDB():
+    """Users of a htpasswd file.
+
+    The file is read again only when its identity changes. Passwords
+    verified in the last ttl seconds are remembered by an HMAC of the
+    user and password, under a key made for this process, so a client
+    sending them on every request does not pay the hash every time.
+    Failed checks are never remembered.
+    """
 
-    def __init__(self, filename):
+    def __init__(self, filename, ttl=DEFAULT_CREDENTIALS_TTL):
+        self.filename = filename
+        self.ttl = ttl
         self.htpasswd = HtpasswdFile(filename)
+        self._stamp = self._file_stamp()
+        self._key = os.urandom(32)
+        self._verified = {}
+        self._lock = threading.Lock()
+
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def _reload(self):
+        stamp = self._file_stamp()
+        if stamp != self._stamp and stamp is not None:
+            # a new one, checks running meanwhile keep the old
+            self.htpasswd = HtpasswdFile(self.filename)
+            self._stamp = stamp
+            # passwords may have changed or users gone
+            self._verified.clear()
 
     def get_users(self):
-        self.htpasswd.get_users()
+        with self._lock:
+            self._reload()
+            return self.htpasswd.users()
 
     def check_password(self, user, password):
-        return self.htpasswd.check_password(user, password)
+        if isinstance(user, unicode):
+            user = user.encode('utf-8')
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        digest = hmac.new(self._key, '%s\0%s' % (user, password),
+                          hashlib.sha256).digest()
+        now = time.time()
+
+        with self._lock:
+            self._reload()
+            if self._verified.get(digest, 0) > now:
+                return True
+            htpasswd = self.htpasswd
+
+        # hashed out of the lock, it is the slow part
+        if not htpasswd.check_password(user, password):
+            return False
+
+        with self._lock:
+            if len(self._verified) >= MAX_CREDENTIALS:
+                self._verified = dict(item for item in self._verified.items()
+                                      if item[1] > now)
+                if len(self._verified) >= MAX_CREDENTIALS:
+                    self._verified.clear()
+            if self.ttl:
+                self._verified[digest] = now + self.ttl
+        return True
+
+
+_userdbs = {}
+_userdbs_lock = threading.Lock()
+
+
+def get_userdb(filename, ttl=DEFAULT_CREDENTIALS_TTL):
+    """The UserDB of filename shared by the whole process"""
+    with _userdbs_lock:
+        userdb = _userdbs.get(filename)
+        if userdb is None:
+            userdb = _userdbs[filename] = UserDB(filename, ttl)
+        return userdb
+
+
+class TicketOrBasicAuthenticationPolicy(object):
+    """Users logged in through the login form, with an auth ticket
+    cookie, or API clients sending HTTP Basic credentials"""
+
+    def __init__(self, secret, htpasswd, ttl=DEFAULT_CREDENTIALS_TTL):
+        self.ticket = AuthTktAuthenticationPolicy(secret)
+        self.basic = BasicAuthAuthenticationPolicy(self.check,
+                                                   realm='Ninja Sysop')
+        self.htpasswd = htpasswd
+        self.ttl = ttl
+
+    def check(self, username, password, request):
+        if get_userdb(self.htpasswd, self.ttl).check_password(username,
+                                                              password):
+            return []
+        return None
+
+    def _policy(self, request):
+        if self.ticket.unauthenticated_userid(request) is not None:
+            return self.ticket
+        return self.basic
+
+    def authenticated_userid(self, request):
+        return self._policy(request).authenticated_userid(request)
+
+    def unauthenticated_userid(self, request):
+        return self._policy(request).unauthenticated_userid(request)
+
+    def effective_principals(self, request):
+        return self._policy(request).effective_principals(request)
+
+    def remember(self, request, principal, **kw):
+        return self.ticket.remember(request, principal, **kw)
+
+    def forget(self, request):
+        return self.ticket.forget(request)
@@ -28,6 +28,13 @@
 # POSSIBILITY OF SUCH DAMAGE.
 # 
 
+import calendar
+import csv
+import hashlib
+import json
+import os
+from email.utils import formatdate
+from StringIO import StringIO
 
 from deform import Form
 import deform
@@ -37,17 +44,143 @@ from deform import Form
 
 from webhelpers.paginate import Page, PageURL_WebOb
 
+from pyramid.response import Response
 from pyramid.view import view_config, view_defaults
-from pyramid.httpexceptions import HTTPFound, HTTPForbidden, HTTPCreated
+from pyramid.httpexceptions import (HTTPFound, HTTPForbidden, HTTPCreated,
+                                    HTTPNotFound, HTTPBadRequest,
+                                    HTTPNotModified)
 from pyramid.security import remember
 from pyramid.security import forget
 from pyramid.security import authenticated_userid
 
 from ninjasysop.layouts import Layouts
-from ninjasysop.userdb import UserDB
+from ninjasysop.userdb import get_userdb
 
 from backends import BackendApplyChangesException
 
+ITEMS_PER_PAGE = 20
+# entries serialized per chunk of a streamed listing
+STREAM_CHUNK = 500
+
+# schema class -> serialized definition
+_schema_definitions = {}
+
+
+def schema_definition(schema):
+    """Fields of a schema class, with their types, built once per class"""
+    definition = _schema_definitions.get(schema)
+    if definition is not None:
+        return definition
+
+    definition = []
+    form = deform.Form(schema())
+    for node in form.children:
+        schema_node = {'name':  node.name,
+                       'required': node.required}
+        if isinstance(node.typ, colander.String):
+            if getattr(node.widget, 'values', None):
+                schema_node['type'] = [key for (key, value) in node.widget.values]
+            else:
+                schema_node['type'] = 'string'
+        elif isinstance(node.typ, colander.Integer):
+            schema_node['type'] = 'integer'
+
+        definition.append(schema_node)
+
+    return _schema_definitions.setdefault(schema, definition)
+
+
+def conditional(request, filenames, *extra):
+    """ETag and Last-Modified headers of the files, taken from their stat
+    alone, and whether the copy the client holds is still good.
+
+    Edits replace the files, so their inode, size or mtime change on every
+    write. extra are other values the response depends on.
+    """
+    identities = [repr(value) for value in extra]
+    modified = None
+    for filename in filenames:
+        try:
+            st = os.stat(filename)
+        except OSError:
+            identities.append(filename)
+            continue
+        identities.append('%d:%d:%d:%r' % (st.st_dev, st.st_ino, st.st_size,
+                                           st.st_mtime))
+        modified = max(modified, int(st.st_mtime))
+
+    etag = hashlib.sha1('\0'.join(identities)).hexdigest()
+    headers = {'ETag': '"%s"' % etag,
+               'Cache-Control': 'private, no-cache'}
+    if modified is not None:
+        headers['Last-Modified'] = formatdate(modified, usegmt=True)
+
+    if 'If-None-Match' in request.headers:
+        fresh = etag in request.if_none_match
+    elif request.if_modified_since is not None and modified is not None:
+        since = calendar.timegm(request.if_modified_since.utctimetuple())
+        fresh = modified <= since
+    else:
+        fresh = False
+    return (headers, fresh)
+
+
+def stream_entries(fields, entries, ndjson=False):
+    """Serializes (item, protected) pairs as a JSON array, or as one JSON
+    object per line, a chunk at a time"""
+    encode = json.JSONEncoder().encode
+    chunk = []
+    for (n, (item, protected)) in enumerate(entries):
+        entry = encode({'item': dict((field, getattr(item, field, None))
+                                     for field in fields),
+                        'protected': protected})
+        if ndjson:
+            chunk.append(entry + '\n')
+        else:
+            chunk.append((',' if n else '[') + entry)
+        if len(chunk) == STREAM_CHUNK:
+            yield ''.join(chunk)
+            chunk = []
+    if not ndjson:
+        chunk.append(']' if entries else '[]')
+    if chunk:
+        yield ''.join(chunk)
+
+
+class BatchFailed(Exception):
+    # undoes a batch whose operations are not all valid
+    def __init__(self, errors):
+        Exception.__init__(self, "%d invalid operations" % len(errors))
+        self.errors = errors
+
+
+def invalid_errors(invalid):
+    """(field, message) pairs of a colander.Invalid and its children"""
+    errors = []
+    for exc in set(exc for path in invalid.paths() for exc in path):
+        for msg in exc.messages():
+            # the validators set Invalid instances as child messages
+            if isinstance(msg, colander.Invalid):
+                msg = msg.msg
+            errors.append((exc.node.name, unicode(msg)))
+    return sorted(errors)
+
+
+def item_select(request, group):
+    # the item_keys of the url, they pick one of the items of a name
+    return dict((key, request.params[key]) for key in group.item_keys
+                if key in request.params)
+
+
+def group_applier(groups, groupname):
+    # runs later on an apply queue thread
+    def apply(username):
+        with groups.writing(groupname) as group:
+            revision = group.apply_changes(username)
+        group.reload(revision)
+    return apply
+
+
 class GroupViews(Layouts):
 
     def __init__(self, request):
@@ -56,14 +189,21 @@ class GroupViews(Layouts):
         if 'backend' in settings:
             self.backend = settings['backend']
         self.files = settings['files']
+        self.groups = settings['groups']
         self.protected_names = settings['protected_names']
         self.settings = settings
 
     @view_config(renderer="templates/group_list.pt", route_name="group_list",
                  permission="view")
     def group_list(self):
-        groups = self.files.keys()
-        return {"groups": groups}
+        groups = sorted(self.files.keys())
+        # with several backends every group tells which one it is
+        labels = {}
+        if len(self.settings['backends']) > 1:
+            labels = dict((group, self.groups.backend_of(group).get_texts()
+                           ['subapp_label']) for group in groups)
+        return {"groups": groups,
+                "labels": labels}
 
     @view_config(renderer="templates/group.pt", route_name="group_items",
                  permission="view")
@@ -71,33 +211,61 @@ class GroupViews(Layouts):
         groupname = self.request.matchdict['groupname']
         page = int(self.request.params['page']) if 'page' in self.request.params else 0
         search = self.request.params['search'] if 'search' in self.request.params else None
-        groupfile = self.files[groupname]
-        group = self.backend(groupname, groupfile)
 
-        if search:
-            items = group.get_items(name=search)
-        else:
-            items = group.get_items()
+        page = max(page, 1)
+
+        backend = self.groups.backend_of(groupname)
+        (validators, fresh) = conditional(
+            self.request, backend.source_files(self.files[groupname]),
+            authenticated_userid(self.request), *backend.source_state())
+        if fresh:
+            return HTTPNotModified(headers=validators)
+        self.request.response.headers.update(validators)
+
+        with self.groups.reading(groupname) as group:
+            items = group.get_items(name=search, order='name',
+                                    offset=(page - 1) * ITEMS_PER_PAGE,
+                                    limit=ITEMS_PER_PAGE)
+            if not items and items.total:
+                # past the end, show the last page
+                page = (items.total - 1) / ITEMS_PER_PAGE + 1
+                items = group.get_items(name=search, order='name',
+                                        offset=(page - 1) * ITEMS_PER_PAGE,
+                                        limit=ITEMS_PER_PAGE)
+            stats = group.get_stats()
+            # the links tell apart the items sharing a name
+            selectors = [group.item_selector(item) for item in items]
 
         entries = []
-        for item in items:
+        for (item, select) in zip(items, selectors):
             entries.append({'item':item,
-                            'protected':  item.name in self.protected_names[groupname]})
+                            'protected':  item.name in self.protected_names[groupname],
+                            'url': self._item_path('item', groupname,
+                                                   item.name, select),
+                            'delete_url': self._item_path('item_delete',
+                                                          groupname,
+                                                          item.name, select)})
 
         page_url = PageURL_WebOb(self.request)
-        entries = Page(entries, page, url=page_url)
+        entries = Page(entries, page, items_per_page=ITEMS_PER_PAGE,
+                       item_count=items.total, presliced_list=True,
+                       url=page_url)
 
         return {"groupname": groupname,
                 "entries": entries,
+                "stats": stats,
                 }
 
     @view_config(renderer="templates/item.pt", route_name="item_add",
                  permission="edit")
     def item_add(self):
         groupname = self.request.matchdict['groupname']
-        groupfile = self.files[groupname]
-        group = self.backend(groupname, groupfile)
+        # validated and added with the write lock, so nobody adds the
+        # same entry meanwhile
+        with self.groups.writing(groupname) as group:
+            return self._item_add(groupname, group)
 
+    def _item_add(self, groupname, group):
         schema = group.get_add_schema()
         form = deform.Form(schema, buttons=('submit',))
 
@@ -118,7 +286,8 @@ class GroupViews(Layouts):
                 response = HTTPFound()
                 response.location = self.request.route_url('item',
                                                             groupname=groupname,
-                                                            itemname=data['name'])
+                                                            itemname=data['name'],
+                                                            _query=self._data_select(group, data))
                 return response
             else:
                 return HTTPForbidden()
@@ -131,12 +300,11 @@ class GroupViews(Layouts):
     def item_delete(self):
         groupname = self.request.matchdict['groupname']
         itemname = self.request.matchdict['itemname']
-        groupfile = self.files[groupname]
-        group = self.backend(groupname, groupfile)
         if itemname in self.protected_names[groupname]:
             raise HTTPForbidden("You can not modify this domain name")
 
-        group.del_item(itemname)
+        with self.groups.writing(groupname) as group:
+            group.del_item(itemname, **item_select(self.request, group))
         response = HTTPFound()
         response.location = self.request.route_url('groupview',
                                                     groupname=groupname)
@@ -147,12 +315,15 @@ class GroupViews(Layouts):
     def item_edit(self):
         groupname = self.request.matchdict['groupname']
         itemname = self.request.matchdict['itemname']
-        groupfile = self.files[groupname]
-        group = self.backend(groupname, groupfile)
+        with self.groups.writing(groupname) as group:
+            return self._item_edit(groupname, itemname, group)
+
+    def _item_edit(self, groupname, itemname, group):
         protected = itemname in self.protected_names[groupname]
+        select = item_select(self.request, group)
         response = {"groupname": groupname,
                     "itemname": itemname,
-                    'item': group.get_item(itemname),
+                    'item': group.get_item(itemname, **select),
                     }
         if self.request.POST and protected:
             return HTTPForbidden("You can not modify this domain name")
@@ -162,7 +333,7 @@ class GroupViews(Layouts):
             return response
 
 
-        schema = group.get_edit_schema(itemname)
+        schema = group.get_edit_schema(itemname, **select)
         form = deform.Form(schema, buttons=('submit', 'delete'))
 
         if 'submit' in self.request.POST and self.request.POST['submit'] == 'submit':
@@ -173,29 +344,43 @@ class GroupViews(Layouts):
                 response['form'] = e.render()
                 return response
             else:
-                group.save_item(group.get_item(itemname), data)
+                group.save_item(group.get_item(itemname, **select), data)
                 texts = group.get_texts()
                 response['flash'] = '%s %s saved' % (texts['item_label'], itemname)
+                select = self._data_select(group, data)
 
-        item = group.get_item(itemname)
+        item = group.get_item(itemname, **select)
         response['form'] = form.render(item.todict())
         return response
 
+    def _data_select(self, group, data):
+        return dict((key, data[key]) for key in group.item_keys)
+
+    def _item_path(self, route, groupname, itemname, select):
+        return self.request.route_path(route, groupname=groupname,
+                                       itemname=itemname, _query=select)
+
     @view_config(renderer="templates/applychanges.pt", route_name="group_apply",
                  permission="edit")
     def applychanges(self):
         groupname = self.request.matchdict['groupname']
-        groupfile = self.files[groupname]
-        group = self.backend(groupname, groupfile)
-        username = authenticated_userid(self.request)
-        try:
-            group.apply_changes(username)
-        except BackendApplyChangesException, e:
+        apply_queue = self.settings['apply_queue']
+
+        if 'job' in self.request.params:
+            job = apply_queue.get(int(self.request.params['job']))
+            if job is None or job.groupname != groupname:
+                return HTTPNotFound()
             return {"groupname": groupname,
-                    "msg": e.message,
+                    "job": job,
                     }
 
-        return {"groupname": groupname}
+        username = authenticated_userid(self.request)
+        job = apply_queue.submit(groupname, username,
+                                 group_applier(self.groups, groupname))
+        # never queue the apply again when the status page is reloaded
+        return HTTPFound(location=self.request.route_url('group_apply',
+                                                         groupname=groupname,
+                                                         _query={'job': job.id}))
 
 
     @view_config(renderer="templates/login.pt", context=HTTPForbidden)
@@ -214,7 +399,8 @@ class GroupViews(Layouts):
         if self.request.POST:
             login = request.params['login']
             password = request.params['password']
-            userdb = UserDB(self.settings['htpasswd'])
+            userdb = get_userdb(self.settings['htpasswd'],
+                                self.settings['credentials_ttl'])
             if userdb.check_password(login, password):
                 headers = remember(request, login)
                 return HTTPFound(location=came_from,
@@ -242,32 +428,26 @@ class BaseRestView(object):
         self.request = request
         settings = self.request.registry.settings
         self.backend = settings['backend']
+        self.backends = settings['backends']
         self.files = settings['files']
+        self.groups = settings['groups']
         self.protected_names = settings['protected_names']
 
+    def _group_files(self, groupname):
+        return self.groups.backend_of(groupname).source_files(
+                                                    self.files[groupname])
+
     def _serializer(self, schema):
-        schema_definition = []
-        form = deform.Form(schema())
-        for node in form.children:
-            schema_node = {'name':  node.name,
-                           'required': node.required}
-            if isinstance(node.typ, colander.String):
-                if getattr(node.widget, 'values', None):
-                    schema_node['type'] = [key for (key, value) in node.widget.values]
-                else:
-                    schema_node['type'] = 'string'
-            elif isinstance(node.typ, colander.Integer):
-                schema_node['type'] = 'integer'
-
-            schema_definition.append(schema_node)
-
-        return schema_definition
+        return schema_definition(schema)
+
+    def _fields(self, group):
+        return [prop['name'] for prop in
+                self._serializer(group.get_add_schema_definition())]
 
     def _serialize_item(self, item, group):
-        schema = self._serializer(group.get_add_schema)
         obj = {}
-        for prop in schema:
-            obj[prop['name']] = getattr(item, prop['name'], None)
+        for name in self._fields(group):
+            obj[name] = getattr(item, name, None)
         return obj
 
 
@@ -286,16 +466,39 @@ class BackendRestViews(BaseRestView):
         groups = self.files.keys()
         return groups
 
+    def _schema_backend(self):
+        # the backend of the group asked for, the default one otherwise
+        groupname = self.request.GET.get('group')
+        if groupname is None:
+            return self.backend
+        if groupname not in self.files:
+            raise HTTPNotFound()
+        return self.groups.backend_of(groupname)
+
     @view_config(route_name="backend_rest_edit_schema", request_method="GET")
     def edit_schema(self):
-        edit_schema = self._serializer(self.backend.get_edit_schema_definition())
+        backend = self._schema_backend()
+        edit_schema = self._serializer(backend.get_edit_schema_definition())
         return edit_schema
 
     @view_config(route_name="backend_rest_add_schema", request_method="GET")
     def add_schema(self):
-        add_schema = self._serializer(self.backend.get_add_schema_definition())
+        backend = self._schema_backend()
+        add_schema = self._serializer(backend.get_add_schema_definition())
         return add_schema
 
+    @view_config(route_name="backend_rest_lookup", request_method="GET")
+    def lookup(self):
+        backends = [self.backend] + [backend for backend in self.backends.values()
+                                     if backend is not self.backend]
+        for backend in backends:
+            try:
+                return backend.lookup(ip=self.request.GET.get('ip'),
+                                      mac=self.request.GET.get('mac'))
+            except NotImplementedError:
+                continue
+        return HTTPNotFound()
+
 
 @view_defaults(route_name="group_rest_view", renderer="json", permission="view")
 class GroupRESTViews(BaseRestView):
@@ -303,8 +506,6 @@ class GroupRESTViews(BaseRestView):
     def __init__(self, request):
         super(GroupRESTViews, self).__init__(request)
         self.groupname = self.request.matchdict['groupname']
-        groupfile = self.files[self.groupname]
-        self.group = self.backend(self.groupname, groupfile)
 
     @view_config(renderer="string", request_method="OPTIONS")
     def options(self):
@@ -316,30 +517,183 @@ class GroupRESTViews(BaseRestView):
     @view_config(request_method="GET")
     def get(self):
         search = self.request.params['search'] if 'search' in self.request.params else None
+        try:
+            offset = int(self.request.params.get('offset', 0))
+            limit = self.request.params.get('limit')
+            limit = int(limit) if limit else None
+        except ValueError:
+            return HTTPBadRequest("offset and limit must be numbers")
+        order = self.request.params.get('order')
+        if order is None and ('offset' in self.request.params or
+                              'limit' in self.request.params):
+            # the pages of an unordered set would not follow each other
+            order = 'name'
+
+        (validators, fresh) = conditional(
+            self.request, self._group_files(self.groupname))
+        if fresh:
+            return HTTPNotModified(headers=validators)
+
+        ndjson = (self.request.params.get('format') == 'ndjson' or
+                  self.request.accept.best_match(['application/json',
+                                                  'application/x-ndjson'])
+                  == 'application/x-ndjson')
+
+        with self.groups.reading(self.groupname) as group:
+            try:
+                items = group.get_items(name=search, offset=max(offset, 0),
+                                        limit=limit, order=order)
+            except AttributeError:
+                return HTTPBadRequest("Can not order by %s" % order)
+            fields = self._fields(group)
+
+        # the items are serialized while the response is sent, out of the
+        # group lock so a slow client does not hold back the writers
+        protected = self.protected_names[self.groupname]
+        entries = [(item, item.name in protected) for item in items]
+        response = Response(app_iter=stream_entries(fields, entries, ndjson),
+                            content_type=('application/x-ndjson' if ndjson
+                                          else 'application/json'))
+        response.headers['X-Total-Count'] = str(items.total)
+        response.headers.update(validators)
+        response.vary = ('Accept',)
+        return response
 
-        if search:
-            items = self.group.get_items(name=search)
+    @view_config(request_method="PUT", permission="edit")
+    def apply_changes(self):
+        apply_queue = self.request.registry.settings['apply_queue']
+        username = authenticated_userid(self.request)
+        job = apply_queue.submit(self.groupname, username,
+                                 group_applier(self.groups, self.groupname))
+        return job.todict()
+
+    @view_config(route_name="group_rest_apply", request_method="GET")
+    def apply_status(self):
+        apply_queue = self.request.registry.settings['apply_queue']
+        if 'job' in self.request.params:
+            job = apply_queue.get(int(self.request.params['job']))
         else:
-            items = self.group.get_items()
+            job = apply_queue.last(self.groupname)
 
-        entries = []
-        for item in items:
-            entries.append({'item':self._serialize_item(item, self.group),
-                            'protected': item.name in self.protected_names[self.groupname]})
+        if job is None or job.groupname != self.groupname:
+            return HTTPNotFound()
+        return job.todict()
 
-        return entries
+    @view_config(route_name="group_rest_import", request_method="POST",
+                 permission="edit")
+    def import_items(self):
+        if self.request.content_type == 'text/csv':
+            rows = list(csv.DictReader(StringIO(self.request.body)))
+        else:
+            try:
+                rows = self.request.json_body
+            except ValueError:
+                rows = None
+            if (not isinstance(rows, list) or
+                not all(isinstance(row, dict) for row in rows)):
+                return HTTPBadRequest("A JSON list of hosts is required")
+
+        with self.groups.writing(self.groupname) as group:
+            try:
+                (values, errors) = group.validate_items(rows)
+            except NotImplementedError:
+                return HTTPNotFound()
+            protected = self.protected_names[self.groupname]
+            errors.extend((n, 'name', "You can not modify this name")
+                          for (n, row) in enumerate(rows)
+                          if row.get('name') in protected)
+            if errors:
+                self.request.response.status = 400
+                return {'errors': [dict(row=n, field=field, message=message)
+                                   for (n, field, message) in sorted(errors)]}
+
+            items = group.add_items(values)
+        return {'added': len(items)}
+
+    @view_config(route_name="group_rest_batch", request_method="POST",
+                 permission="edit")
+    def batch(self):
+        try:
+            operations = self.request.json_body
+        except ValueError:
+            operations = None
+        if (not isinstance(operations, list) or
+            not all(isinstance(operation, dict) and
+                    isinstance(operation.get('item', {}), dict)
+                    for operation in operations)):
+            return HTTPBadRequest("A JSON list of operations is required")
+        protected = self.protected_names[self.groupname]
+        try:
+            with self.groups.writing(self.groupname) as group:
+                with group.batch():
+                    errors = []
+                    for (n, operation) in enumerate(operations):
+                        errors.extend((n, field, message) for (field, message)
+                                      in self._run(group, operation,
+                                                   protected))
+                    if errors:
+                        raise BatchFailed(errors)
+        except BatchFailed, e:
+            self.request.response.status = 400
+            return {'errors': [dict(op=n, field=field, message=message)
+                               for (n, field, message) in e.errors]}
+        return {'applied': len(operations)}
+
+    def _run(self, group, operation, protected):
+        """Validates and does one operation of a batch, returns its errors
+        as (field, message) pairs"""
+        op = operation.get('op')
+        values = operation.get('item', {})
+        # the keys besides op and item select the item, as get_item takes
+        select = dict((key, value) for (key, value) in operation.items()
+                      if key not in ('op', 'item'))
+        if (select.get('name') in protected or
+            values.get('name') in protected):
+            return [('name', "You can not modify this name")]
+
+        if op == 'add':
+            schema = group.get_add_schema()
+        elif op in ('update', 'delete'):
+            try:
+                old = group.get_item(**select)
+            except (KeyError, TypeError):
+                old = None
+            if old is None:
+                return [('name', "Item not found")]
+            if op == 'delete':
+                group.del_item(**select)
+                return []
+            schema = group.get_edit_schema(**select)
+            # fields left out keep their value
+            values = dict(self._serialize_item(old, group), **values)
+        else:
+            return [('op', "Unknown operation %s" % op)]
 
-    @view_config(request_method="PUT", permission="edit")
-    def apply_changes(self):
-        groupname = self.request.matchdict['groupname']
         try:
-            self.backend.apply_changes(groupname, username)
-        except self.backendReloadError, e:
-            return {"groupname": groupname,
-                    "msg": e.message,
-                    }
+            data = schema.deserialize(values)
+        except colander.Invalid, e:
+            return invalid_errors(e)
+        if op == 'add':
+            group.add_item(data)
+        else:
+            group.save_item(old, data)
+        return []
 
-        return ''
+    @view_config(route_name="group_rest_revisions", request_method="GET")
+    def revisions(self):
+        with self.groups.reading(self.groupname) as group:
+            revisions = group.get_revisions()
+        return [revision._asdict() for revision in revisions]
+
+    @view_config(route_name="group_rest_revisions", request_method="PUT",
+                 permission="edit")
+    def restore_revision(self):
+        try:
+            with self.groups.writing(self.groupname) as group:
+                revision = group.restore_revision(self.request.PUT['serial'])
+        except KeyError:
+            return HTTPNotFound()
+        return revision._asdict()
 
 @view_defaults(route_name="item_rest_view", renderer="json", permission="view")
 class ItemRESTView(BaseRestView):
@@ -347,11 +701,20 @@ class ItemRESTView(BaseRestView):
     def __init__(self, request):
         super(ItemRESTView, self).__init__(request)
         self.groupname = self.request.matchdict['groupname']
-        groupfile = self.files[self.groupname]
-        self.group = self.backend(self.groupname, groupfile)
         self.itemname = self.request.matchdict['itemname']
         self.is_protected = self.itemname in self.protected_names[self.groupname]
 
+    def _select(self, group):
+        # a bare name only picks the item of a name holding one
+        select = item_select(self.request, group)
+        matches = group.get_items(name_exact=self.itemname, **select)
+        if not matches:
+            raise HTTPNotFound()
+        if len(matches) > 1:
+            raise HTTPBadRequest("%s holds several items, pick one by %s" %
+                                 (self.itemname, ', '.join(group.item_keys)))
+        return select
+
     @view_config(renderer="string", request_method="OPTIONS")
     def options(self):
         headers = self.request.response.headers
@@ -361,57 +724,71 @@ class ItemRESTView(BaseRestView):
 
     @view_config(request_method="GET", permission="edit")
     def get(self):
-        item = self.group.get_item(self.itemname)
-        return self._serialize_item(item, self.group)
+        (validators, fresh) = conditional(
+            self.request, self._group_files(self.groupname))
+        if fresh:
+            return HTTPNotModified(headers=validators)
+        self.request.response.headers.update(validators)
+
+        with self.groups.reading(self.groupname) as group:
+            item = group.get_item(self.itemname, **self._select(group))
+            return self._serialize_item(item, group)
+
+    def _values(self):
+        try:
+            values = self.request.json_body
+        except ValueError:
+            values = None
+        if not isinstance(values, dict):
+            raise HTTPBadRequest("A JSON object is required")
+        return values
+
+    def _invalid(self, invalid):
+        self.request.response.status = 400
+        return {'errors': [dict(field=field, message=message)
+                           for (field, message) in invalid_errors(invalid)]}
 
     @view_config(request_method="PUT", permission="edit")
     def put(self):
         if self.is_protected:
             return HTTPForbidden("You can not modify this domain name")
-        schema = self.group.get_add_schema()
-        form = deform.Form(schema, buttons=('submit',))
-        controls = self.request.PUT.items()
-        try:
-            data = form.validate(controls)
-        except deform.ValidationFailure, e:
-            ## FIXME return errors
-            response['form'] = e.render()
-            return response
-
-        if data['name'] in self.protected_names[self.groupname]:
-            return HTTPForbidden("You can not modify this domain name")
-
-        group.add_item(**data)
-        response = HTTPFound()
+        values = dict(self._values(), name=self.itemname)
+        with self.groups.writing(self.groupname) as group:
+            try:
+                data = group.get_add_schema().deserialize(values)
+            except colander.Invalid, e:
+                return self._invalid(e)
+            item = group.add_item(data)
+            self.request.response.status = 201
+            return self._serialize_item(item, group)
 
     @view_config(request_method="POST", permission="edit")
     def post(self):
-
         if self.is_protected:
             return HTTPForbidden("You can not modify this domain name")
+        values = self._values()
+        if values.get('name') in self.protected_names[self.groupname]:
+            return HTTPForbidden("You can not modify this domain name")
 
-        schema = group.get_edit_schema(self.itemname)
-        form = deform.Form(schema, buttons=('submit',))
-        controls = self.request.POST.items()
-        controls.append((u'name', itemname))
-        try:
-            data = form.validate(controls)
-        except deform.ValidationFailure, e:
-            ## FIXME error response
-            response['form'] = e.render()
-            return response
-        else:
-            group.save_item(group.get_item(self.itemname), **data)
-            response = HTTPFound()
-            return response
-
-        return response
+        with self.groups.writing(self.groupname) as group:
+            select = self._select(group)
+            old = group.get_item(self.itemname, **select)
+            # fields left out keep their value
+            values = dict(self._serialize_item(old, group), **values)
+            try:
+                data = group.get_edit_schema(self.itemname,
+                                             **select).deserialize(values)
+            except colander.Invalid, e:
+                return self._invalid(e)
+            item = group.save_item(old, data)
+            return self._serialize_item(item, group)
 
     @view_config(request_method="DELETE",  permission="edit")
     def delete(self):
         if self.is_protected:
             raise HTTPForbidden("You can not modify this domain name")
 
-        group.del_item(self.itemname)
+        with self.groups.writing(self.groupname) as group:
+            group.del_item(self.itemname, **self._select(group))
         response = HTTPFound()
         return response
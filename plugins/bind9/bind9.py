@@ -27,37 +27,46 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 #
+import gc
+import logging
 import re
-import subprocess
-import shutil
 
 import deform
 
-from ninjasysop.backends import Backend, BackendApplyChangesException
+from ninjasysop.backends import (Backend, BackendApplyChangesException,
+                                 ItemIndex, atomic_files, bound_schema,
+                                 parsed_files, run_command)
+from ninjasysop.revisions import RevisionStore
 
 from forms import EntrySchema, EntryValidator
 from texts import texts
+from nsupdate import lines_records, update_script, zone_delta
+from zoneparser import ZoneParser, absolute_name
 from datetime import datetime
 
-# SERIAL = yyyymmddnn ; serial
-PARSER_RE = {
-    'serial':re.compile(r'(?P<serial>\d{10}) *; *serial'),
-    'record':re.compile(r'^(?P<name>(?:[a-zA-Z0-9-.]*|@)) *(?:(?P<ttl>\d+)'
-                        r' *|)(?:IN *|)(?P<type>A|CNAME)'
-                        r' *(?P<target>[a-zA-Z0-9-.]*)'
-                        r'(?:(?: *|);(?P<comment>.*)$|)'),
-}
-
-MATCH_RE_STR = {
-    'record':r'^{name} *(?:\d+ *|)(?:IN *|){rtype}',
-    'serial':r'(?: *)(?P<serial>\d{10}) *;(?: *)serial',
-}
+# SERIAL = yyyymmddnn, the third field of the SOA record
+SERIAL_RE_STR = r'(?:^|(?<=[\s(])){serial}(?=[\s)]|$)'
 
 RELOAD_COMMAND = "/usr/sbin/rndc reload"
+# a dynamic zone is loaded again between a freeze and a thaw, BIND
+# refuses to reload it otherwise
+FREEZE_COMMAND = "/usr/sbin/rndc freeze"
+THAW_COMMAND = "/usr/sbin/rndc thaw"
+# writes the zone file of a dynamic zone and removes its journal
+SYNC_COMMAND = "/usr/sbin/rndc sync -clean"
+# bigger deltas are applied reloading the whole zone
+MAX_DELTA = 1000
+
+log = logging.getLogger(__name__)
 
+# the name is hidden when editing, typed when adding
+NAME_WIDGET = deform.widget.TextInputWidget()
 
 
 class Item(object):
+    # zones hold hundreds of thousands of records
+    __slots__ = ('name', 'type', 'target', 'ttl', 'comment')
+
     def __init__(self, name, type, target, ttl=0, comment=''):
         self.name = name
         self.type = type
@@ -76,27 +85,150 @@ class Item(object):
                     comment = self.comment)
 
 
+class RecordStore(object):
+    """Records of a zone grouped in RRsets.
+
+    Maps every owner name to its RRsets by type, and every RRset maps
+    its targets to the records, so a round robin name or an @ with NS,
+    MX and A records keeps all of them. Looking up the RRsets of a name
+    and adding or removing one record are O(1). The records are also
+    indexed by type and target for searches.
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.count = 0
+        self.index = ItemIndex(self, ('type', 'target'))
+
+    def add(self, item):
+        rrset = self.names.setdefault(item.name, {}).setdefault(item.type, {})
+        if item.target in rrset:
+            self.index.remove(rrset[item.target])
+        else:
+            self.count += 1
+        rrset[item.target] = item
+        self.index.add(item)
+
+    def remove(self, item):
+        try:
+            rrsets = self.names[item.name]
+            rrset = rrsets[item.type]
+            del rrset[item.target]
+        except KeyError:
+            raise KeyError("Record %s %s %s not found" % (item.name, item.type,
+                                                          item.target))
+        self.count -= 1
+        self.index.remove(item)
+        if not rrset:
+            del rrsets[item.type]
+            if not rrsets:
+                del self.names[item.name]
+
+    def rrsets(self, name):
+        return self.names.get(name, {})
+
+    def rrset(self, name, type):
+        return self.rrsets(name).get(type, {}).values()
+
+    def get(self, name, type=None, target=None):
+        rrsets = self.names[name]
+        if type is None:
+            # the first record of the name, whatever its type
+            type = iter(rrsets).next()
+        rrset = rrsets[type]
+        if target is None:
+            return rrset.itervalues().next()
+        return rrset[target]
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __iter__(self):
+        for rrsets in self.names.itervalues():
+            for rrset in rrsets.itervalues():
+                for item in rrset.itervalues():
+                    yield item
+
+    def __len__(self):
+        return self.count
+
+
 class ZoneFile(object):
-    def __init__(self, filename):
+    def __init__(self, filename, origin=''):
         self.filename = filename
+        self.origin = "%s." % origin.rstrip('.') if origin else ''
+        self.lines = []
+        # (name, type, target) -> (first line, last line, $ORIGIN there)
+        self.index = {}
+        self.serial = None
+        self.serial_line = None
+        self.default_ttl = None
+        self.tail_origin = self.origin
+
+    def __relative_name(self, name):
+        if name == self.origin:
+            return '@'
+        if self.origin and name.endswith('.' + self.origin):
+            return name[:-len(self.origin) - 1]
+        return name
+
+    def __owner(self, name, origin):
+        # names are relative to the zone, write them absolute where the
+        # file has moved to another $ORIGIN
+        if origin == self.origin:
+            return name
+        return absolute_name(name, self.origin)
 
     def readfile(self):
-        serial = None
-        names = {}
+        records = RecordStore()
+        self.index = {}
+        self.serial = None
+        self.serial_line = None
+
         with open(self.filename, 'r') as zonefile:
-            for line in zonefile.readlines():
-                serial_line = PARSER_RE['serial'].search(line)
-                if serial_line:
-                    serial = serial_line.group('serial')
+            self.lines = zonefile.readlines()
+        if self.lines and not self.lines[-1].endswith('\n'):
+            self.lines[-1] += '\n'
+
+        relative_name = self.__relative_name
+        parser = ZoneParser(self.origin, filename=self.filename)
+        # the collector would walk every record built so far, several
+        # times, while a big zone is loaded
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for record in parser.parse(self.lines):
+                (filename, start, end, name, ttl, rclass, rtype, rdata,
+                 comment, origin, default_ttl) = record
+                if rtype == 'SOA':
+                    if self.serial is None and filename == self.filename:
+                        self.serial = rdata[2]
+                        self.serial_line = self.__find_serial(record)
                     continue
-                record_line = PARSER_RE['record'].search(line)
-                if record_line:
-                    record = Item(**record_line.groupdict())
-                    names[str(record)] = record
-        return (serial, names)
-
-    def __str_record(self, record):
-        recordstr = record.name
+
+                item = Item(relative_name(name), rtype, ' '.join(rdata), ttl,
+                            comment)
+                records.add(item)
+                # records from $INCLUDE files are not editable
+                if filename == self.filename:
+                    self.index[(item.name, rtype, item.target)] = (start, end,
+                                                                   origin)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        self.default_ttl = parser.ttl
+        self.tail_origin = parser.origin
+        return (self.serial, records)
+
+    def __find_serial(self, record):
+        match = re.compile(SERIAL_RE_STR.format(serial=record.rdata[2]))
+        for n in xrange(record.start, record.end + 1):
+            if match.search(self.lines[n].partition(';')[0]):
+                return n
+
+    def __str_record(self, record, origin):
+        recordstr = self.__owner(record.name, origin)
         if record.ttl:
             recordstr += " {0}".format(str(record.ttl))
 
@@ -108,159 +240,158 @@ class ZoneFile(object):
         recordstr += '\n'
         return recordstr
 
-    def __str_serial(self, serial):
-        return "%s ;serial aaaammdd\n" % serial
-
-    def add_record(self, record):
-        with open(self.filename, 'r') as zonefile:
-            lines = zonefile.readlines()
-            lines.append(self.__str_record(record))
+    def __content(self):
+        # removed records are kept as None so the indexed positions
+        # of the following lines never move
+        return ''.join(line for line in self.lines if line is not None)
 
-        with open(self.filename, 'w') as zonefile:
-            zonefile.writelines(lines)
+    def __writefile(self):
+        # joined only when written, once for a batch of edits
+        atomic_files.write(self.filename, self.__content)
 
-    def save_record(self, old_record, record):
-        match = re.compile(MATCH_RE_STR['record'].format(name=old_record.name,
-                                                         rtype=old_record.type))
-        zonefile = open(self.filename, 'r')
-        lines = zonefile.readlines()
-        zonefile.close()
-        n = 0
-        while n < len(lines) and not match.match(lines[n]):
-            n += 1
-
-        if n == len(lines):
-            raise(KeyError, "Record %s not found" % record.name)
-        else:
-            lines[n] = self.__str_record(record)
+    def __record_span(self, record):
+        try:
+            return self.index.pop((record.name, record.type, record.target))
+        except KeyError:
+            raise KeyError("Record %s not found" % record.name)
+
+    def __splice(self, start, end, line):
+        self.lines[start] = line
+        for n in xrange(start + 1, end + 1):
+            self.lines[n] = None
+
+    def __pin_owner(self, end, name, origin):
+        # a next record without owner was inheriting it from the changed one
+        for n in xrange(end + 1, len(self.lines)):
+            line = self.lines[n]
+            if line is None or not line.strip() or line.lstrip()[0] == ';':
+                continue
+            if line[0] in ' \t':
+                self.lines[n] = self.__owner(name, origin) + line
+            return
 
-        zonefile = open(self.filename, 'w')
-        print lines
-        zonefile.writelines(lines)
-        zonefile.close()
+    def add_record(self, record):
+        self.lines.append(self.__str_record(record, self.tail_origin))
+        n = len(self.lines) - 1
+        self.index[(record.name, record.type,
+                    record.target)] = (n, n, self.tail_origin)
+        self.__writefile()
 
+    def save_record(self, old_record, record):
+        (start, end, origin) = self.__record_span(old_record)
+        self.__splice(start, end, self.__str_record(record, origin))
+        if old_record.name != record.name:
+            self.__pin_owner(end, old_record.name, origin)
+        self.index[(record.name, record.type,
+                    record.target)] = (start, start, origin)
+        self.__writefile()
 
     def remove_record(self, record):
-        match = re.compile(MATCH_RE_STR['record'].format(name=record.name,
-                                                         rtype=record.type))
-        zonefile = open(self.filename, 'r')
-        lines = zonefile.readlines()
-        zonefile.close()
-        n = 0
-        while n < len(lines) and not match.match(lines[n]):
-            n += 1
-
-        if n == len(lines):
-            raise KeyError("Not Found, %s can't be deleted" % record.name)
-        else:
-            del lines[n]
-
-        zonefile = open(self.filename, 'w')
-        zonefile.writelines(lines)
-        zonefile.close()
+        (start, end, origin) = self.__record_span(record)
+        self.__splice(start, end, None)
+        self.__pin_owner(end, record.name, origin)
+        self.__writefile()
 
     def save_serial(self, serial):
-        match = re.compile(MATCH_RE_STR['serial'])
-
-        zonefile = open(self.filename, 'r')
-        lines = zonefile.readlines()
-        zonefile.close()
-
-        n = 0
-        while n < len(lines) and not match.match(lines[n]):
-            n += 1
-
-        if n == len(lines):
+        if self.serial_line is None:
             raise KeyError("Serial not found in file %s" % self.filename)
-        else:
-            serial_re = re.search(MATCH_RE_STR['serial'], lines[n])
-            serial = serial_re.group('serial')
-            lines[n] = self.__str_serial(serial)
 
-        zonefile = open(self.filename, 'w')
-        zonefile.writelines(lines)
-        zonefile.close()
+        line = self.lines[self.serial_line]
+        match = re.search(SERIAL_RE_STR.format(serial=self.serial), line)
+        self.lines[self.serial_line] = "%s%s%s" % (line[:match.start()],
+                                                   serial,
+                                                   line[match.end():])
+        self.serial = str(serial)
+        self.__writefile()
 
 
 class Bind9(Backend):
+
+    update_command = None
+    max_delta = MAX_DELTA
+    # a name may have many records
+    item_keys = ('type', 'target')
+
     def __init__(self, name, filename):
         super(Bind9, self).__init__(name, filename)
         self.groupname = name
-        self.zonefile = ZoneFile(filename)
-        (self.serial, self.items) = self.zonefile.readfile()
+        self.refresh()
+        self.revisions = RevisionStore(filename, self.revisions_keep)
+        # (manifest, records) of the revision last applied as a delta
+        self.applied = (None, None)
+
+    def refresh(self):
+        # the zonefile keeps the line index of the parsed records, so it
+        # is cached along with them
+        if not self.stale():
+            return
+        self.stamp = parsed_files.stamp(self.filename)
+        (self.zonefile, self.serial,
+         self.items) = parsed_files.get(self.filename, self._readfile)
         assert self.serial, "ERROR: Serial is undefined on %s" % self.filename
 
-    def del_item(self, name):
-        self.zonefile.remove_record(self.items[name])
-        del self.items[name]
+    def del_item(self, name, type=None, target=None):
+        record = self.items.get(name, type, target)
+        with self.batch():
+            self.zonefile.remove_record(record)
+            self.items.remove(record)
 
-    def get_item(self, name):
-        return self.items[name]
+    def get_item(self, name, type=None, target=None):
+        return self.items.get(name, type, target)
+
+    def get_rrsets(self, name):
+        return dict((type, rrset.values())
+                    for (type, rrset) in self.items.rrsets(name).items())
 
     def get_items(self, name=None, type=None, target=None,
-                    name_exact=None):
-        filters = []
-
-        if name:
-            def filter_name(r):
-                return r.name.find(name) >= 0
-            filters.append(filter_name)
-
-        if type:
-            def filter_type(r):
-                return r.type == type
-            filters.append(filter_type)
-
-        if target:
-            def filter_target(r):
-                return r.target == target
-            filters.append(filter_target)
-
-        if name_exact:
-            def filter_name_exact(r):
-                return r.name == name >= 0
-            filters.append(filter_name)
-
-        if filters:
-            return filter(lambda item: all([f(item) for f in filters]),
-                         self.items.values())
-        else:
-            return self.items.values()
+                    name_exact=None, offset=0, limit=None, order=None):
+        return self.items.index.filter(name=name, name_exact=name_exact,
+                                       type=type, target=target,
+                                       offset=offset, limit=limit,
+                                       order=order)
+
+    def entry_name(self, name):
+        """name as stored in the zone, relative to its origin"""
+        if name.endswith(self.groupname):
+            return name.replace(".%s" % self.groupname, "")
+        elif name.endswith('.'):
+            return name[:-1]
+        return name
 
     def add_item(self, obj):
-        if obj["name"].endswith(self.groupname):
-            entry = obj["name"].replace(".%s" % self.groupname, "")
-        elif obj["name"].endswith('.'):
-            entry = obj["name"][:-1]
-        else:
-            entry = obj["name"]
-
-        record = Item(name=entry,
+        record = Item(name=self.entry_name(obj["name"]),
                         type=obj["type"],
                         target=obj["target"],
                         comment=obj["comment"],
                         ttl=obj["ttl"])
 
-        self.zonefile.add_record(record)
-        self.items[str(record)] = record
-
+        with self.batch():
+            self.zonefile.add_record(record)
+            self.items.add(record)
+        return record
 
     def save_item(self, old_record, data):
-        if data["name"].endswith(self.groupname):
-            entry = data["name"].replace(".%s" % self.groupname, "")
-        elif data["name"].endswith('.'):
-            entry = data["name"][:-1]
-        else:
-            entry = data["name"]
-
-        record = Item(name=entry,
+        record = Item(name=self.entry_name(data["name"]),
                         type=data["type"],
                         target=data["target"],
                         comment=data["comment"],
                         ttl=data["ttl"])
 
-        self.zonefile.save_record(old_record, record)
-        self.items[str(record)] = record
+        with self.batch():
+            self.zonefile.save_record(old_record, record)
+            self.items.remove(old_record)
+            self.items.add(record)
+        return record
+
+    def _readfile(self):
+        zonefile = ZoneFile(self.filename, self.groupname)
+        (serial, items) = zonefile.readfile()
+        return (zonefile, serial, items)
+
+    def _update_cache(self):
+        self.stamp = parsed_files.update(self.filename, (self.zonefile,
+                                                         self.serial,
+                                                         self.items))
 
 
 
@@ -270,36 +401,120 @@ class Bind9(Backend):
         if self.serial.startswith(today_str):
             change = self.serial[8:]
             inc_change = int(change) + 1
-            serial = long("%s%02d" % (today_str, inc_change))
+            serial = "%s%02d" % (today_str, inc_change)
         else:
-            serial = long("%s01" % today_str)
-        self.zonefile.save_serial(self.serial)
-        self.serial = serial
+            serial = "%s01" % today_str
+        with self.batch():
+            self.zonefile.save_serial(serial)
+            self.serial = serial
 
     def freeze_file(self, username):
         # generate a copy of actual file with username.serial extension
         pass
 
     def apply_changes(self, username):
-        cmd=RELOAD_COMMAND
         self.__update_serial()
-        save_filename = "%s.%s.%s" % (self.filename, self.serial, username)
-        shutil.copy(self.filename, save_filename)
-        try:
-            subprocess.check_output("%s %s" % (cmd, self.groupname),
-                                    stderr=subprocess.STDOUT, shell=True)
-        except subprocess.CalledProcessError, e:
-            raise BackendApplyChangesException(e.output)
+        return self.revisions.save(self.serial, username)
+
+    def reload(self, revision):
+        cmd=RELOAD_COMMAND
+        if not self.update_command:
+            run_command("%s %s" % (cmd, self.groupname), self.apply_timeout)
+            return
 
-    def get_edit_schema(self, name):
-        return EntrySchema(validator=EntryValidator(self))
+        # the zone is dynamic, BIND writes its file too
+        try:
+            if self.__apply_delta(revision):
+                # or BIND would write the file whenever it likes
+                self.__keep_file(SYNC_COMMAND)
+            else:
+                self.applied = (None, None)
+                self.__keep_file(FREEZE_COMMAND)
+                self.__rndc(THAW_COMMAND)
+        except BackendApplyChangesException:
+            # what BIND holds is unknown, the next apply reloads the zone
+            self.applied = (False, None)
+            raise
+
+    def __keep_file(self, command):
+        # BIND writes the file of a dynamic zone on freeze and sync in its
+        # own format, the group keeps its own and the edits made since
+        with self.lock.writing():
+            self.refresh()
+            with open(self.filename, 'r') as zonefile:
+                content = zonefile.read()
+            try:
+                self.__rndc(command)
+            finally:
+                atomic_files.write(self.filename, content)
+                self._update_cache()
+
+    def __rndc(self, command):
+        run_command("%s %s" % (command, self.groupname), self.apply_timeout)
+
+    def __records(self, revision, content):
+        # records of a revision, the chunks shared with content are not
+        # read from the store
+        if self.applied[0] == revision.manifest:
+            return self.applied[1]
+        return lines_records(self.revisions.read(revision, content)
+                             .splitlines(True), self.groupname, self.filename)
+
+    def __apply_delta(self, revision):
+        # the base is the revision before, unless this process knows
+        # BIND holds another one
+        revisions = self.revisions.list()
+        if len(revisions) < 2:
+            return False
+        previous = revisions[-2]
+        if self.applied[0] not in (None, previous.manifest):
+            return False
+        # the file may have edits made after the revision
+        with open(self.filename, 'r') as zonefile:
+            content = self.revisions.read(revision, zonefile.read())
+        old_records = self.__records(previous, content)
+        records = lines_records(content.splitlines(True), self.groupname,
+                                self.filename)
+        (deleted, added) = zone_delta(old_records, records)
+        if len(deleted) + len(added) > self.max_delta:
+            return False
+        try:
+            run_command(self.update_command, self.apply_timeout,
+                        update_script(self.groupname, deleted, added))
+        except BackendApplyChangesException, e:
+            log.warning("Update of %s failed, reloading it: %s",
+                        self.groupname, e.message)
+            return False
+        self.applied = (revision.manifest, records)
+        return True
+
+    def get_revisions(self):
+        return self.revisions.list()
+
+    def restore_revision(self, serial):
+        revision = self.revisions.restore(serial)
+        # the serial keeps growing, or the secondaries would ignore the zone
+        current_serial = self.serial
+        self.refresh()
+        with self.batch():
+            self.zonefile.save_serial(current_serial)
+            self.serial = current_serial
+        return revision
+
+    def get_edit_schema(self, name, type=None, target=None):
+        old = self.get_item(name, type, target)
+        return bound_schema(EntrySchema, EntryValidator(self, old=old))
 
     def get_add_schema(self):
-        schema = EntrySchema(validator=EntryValidator(self))
-        for field in schema.children:
-            if field.name == 'name':
-                field.widget = deform.widget.TextInputWidget()
-        return EntrySchema(validator=EntryValidator(self))
+        return bound_schema(EntrySchema, EntryValidator(self),
+                            name={'widget': NAME_WIDGET})
+
+    @classmethod
+    def configure(cls, settings):
+        super(Bind9, cls).configure(settings)
+        cls.update_command = settings.get('ninjasysop.update_command')
+        cls.max_delta = int(settings.get('ninjasysop.update_max_delta',
+                                         MAX_DELTA))
 
     @classmethod
     def get_edit_schema_definition(self):
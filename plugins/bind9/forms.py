@@ -37,6 +37,12 @@ from ninjasysop.validators import ip_validator
 recordtype_choices = (
     ('CNAME', 'CNAME'),
     ('A', 'A'),
+    ('AAAA', 'AAAA'),
+    ('MX', 'MX'),
+    ('NS', 'NS'),
+    ('TXT', 'TXT'),
+    ('SRV', 'SRV'),
+    ('PTR', 'PTR'),
 )
 
 RE_NAME =  r"^[\w.]+[^.]$"
@@ -61,21 +67,35 @@ class EntrySchema(colander.MappingSchema):
 
 class EntryValidator:
 
-    def __init__(self, group, new=False):
+    def __init__(self, group, new=False, old=None):
         self.group = group
         self.new = False
+        # the record being edited, it does not conflict with itself
+        self.old = old
 
     def __call__(self, form, value):
         from bind9 import Item
         item = Item(**value)
-        item_group = self.group.get_items(name=item.name)
+        # checked against the records of the name it is stored with
+        rrsets = self.group.get_rrsets(self.group.entry_name(item.name))
+        if self.old is not None and self.old.type in rrsets:
+            rrsets[self.old.type] = [record for record in rrsets[self.old.type]
+                                     if record is not self.old]
+        types = set(type for (type, rrset) in rrsets.items() if rrset)
 
-        if ((self.new and len(item_group) > 0) or
-            (not self.new and len(item_group) > 1)):
-                exc = colander.Invalid(form, 'Invalid name, it already exist')
-                exc['target'] = colander.Invalid(
-                        form, "This name is already exist")
-                raise exc
+        if item.target in [record.target
+                           for record in rrsets.get(item.type, [])]:
+            exc = colander.Invalid(form, 'Invalid record, it already exist')
+            exc['target'] = colander.Invalid(
+                    form, "This record is already exist")
+            raise exc
+
+        if ((item.type == 'CNAME' and types) or
+            (item.type != 'CNAME' and 'CNAME' in types)):
+            exc = colander.Invalid(form, 'Invalid name, it already exist')
+            exc['type'] = colander.Invalid(
+                    form, "A CNAME can not share its name with other records")
+            raise exc
 
         if item.type == 'A':
             ip_validator(form, item.target)
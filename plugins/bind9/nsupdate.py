@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) <2012> Antonio Pérez-Aranda Alcaide (ant30) <ant30tx@gmail.com>
+#                      Antonio Pérez-Aranda Alcaide (Yaco Sistemas SL) <aperezaranda@yaco.es>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of copyright holders nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL COPYRIGHT HOLDERS OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Record level changes between two versions of a zone.
+
+zone_records() reads a zone into a set of absolute records, the delta
+between the last applied revision and the current one is sent to a
+nsupdate like command by update_script() instead of reloading the zone.
+"""
+from zoneparser import parse_zone, absolute_name
+
+# positions of the domain names in the rdata, made absolute as nsupdate
+# has no $ORIGIN
+NAME_FIELDS = {'CNAME': (0,), 'NS': (0,), 'PTR': (0,), 'DNAME': (0,),
+               'MX': (1,), 'SRV': (3,), 'SOA': (0, 1)}
+
+
+def zone_records(filename, origin):
+    """Set of (name, ttl, type, rdata) of the zone in filename"""
+    with open(filename, 'r') as zonefile:
+        return lines_records(zonefile, origin, filename)
+
+
+def lines_records(lines, origin, filename=None):
+    """zone_records() of the lines of a zone, $INCLUDE paths are relative
+    to filename"""
+    origin = "%s." % origin.rstrip('.')
+    records = set()
+    for record in parse_zone(lines, origin, filename=filename):
+        rdata = list(record.rdata)
+        for n in NAME_FIELDS.get(record.type, ()):
+            if n < len(rdata):
+                rdata[n] = absolute_name(rdata[n], record.origin)
+        ttl = record.ttl if record.ttl is not None else record.default_ttl
+        records.add((record.name, ttl, record.type, ' '.join(rdata)))
+    return frozenset(records)
+
+
+def zone_delta(old, new):
+    """Records (deleted, added) from old to new"""
+    # the SOA can not be deleted, adding the new one replaces it
+    deleted = sorted(record for record in old - new if record[2] != 'SOA')
+    added = sorted(new - old)
+    return (deleted, added)
+
+
+def update_script(zone, deleted, added):
+    zone = "%s." % zone.rstrip('.')
+    lines = ["zone %s" % zone]
+    for (name, ttl, type, rdata) in deleted:
+        lines.append("update delete %s %s %s" % (name, type, rdata))
+    for (name, ttl, type, rdata) in added:
+        if ttl is None:
+            lines.append("update add %s %s %s" % (name, type, rdata))
+        else:
+            lines.append("update add %s %d %s %s" % (name, ttl, type, rdata))
+    lines.append("send")
+    return '\n'.join(lines) + '\n'
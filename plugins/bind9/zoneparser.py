@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) <2012> Antonio Pérez-Aranda Alcaide (ant30) <ant30tx@gmail.com>
+#                      Antonio Pérez-Aranda Alcaide (Yaco Sistemas SL) <aperezaranda@yaco.es>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of copyright holders nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL COPYRIGHT HOLDERS OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Streaming parser for RFC 1035 master files.
+
+parse_zone() reads the lines of a zone file once, joining the lines of
+parenthesized records and following $ORIGIN, $TTL and $INCLUDE, and
+yields its records one by one, so only the current entry is held in
+memory whatever the size of the zone.
+"""
+import os
+import re
+from collections import namedtuple
+
+CLASSES = frozenset(('IN', 'CH', 'HS', 'CS'))
+# common types, anything else is checked for a TTL or class first
+TYPES = frozenset(('A', 'AAAA', 'CNAME', 'MX', 'NS', 'PTR', 'SOA', 'SRV',
+                   'TXT', 'SPF', 'CAA', 'DS', 'DNSKEY', 'NAPTR', 'SSHFP',
+                   'TLSA'))
+
+TOKEN_RE = re.compile(r'"(?:[^"\\]|\\.)*"|[()]|;.*|(?:[^\s"();\\]|\\.)+')
+TTL_RE = re.compile(r'(\d+)([smhdw]?)', re.IGNORECASE)
+TTL_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+# start and end are the first and last line of the record in its file,
+# name is absolute when an origin is known, ttl is None unless the record
+# sets it and default_ttl is the $TTL in effect
+Record = namedtuple('Record', ('filename', 'start', 'end', 'name', 'ttl',
+                               'rclass', 'type', 'rdata', 'comment',
+                               'origin', 'default_ttl'))
+
+
+class ZoneSyntaxError(ValueError):
+    pass
+
+
+def parse_ttl(value):
+    if value.isdigit():
+        return int(value)
+    ttl = 0
+    pos = 0
+    for match in TTL_RE.finditer(value):
+        if match.start() != pos:
+            break
+        ttl += int(match.group(1)) * TTL_UNITS[match.group(2).lower()]
+        pos = match.end()
+    if pos != len(value) or not pos:
+        raise ZoneSyntaxError("%s is not a valid TTL" % value)
+    return ttl
+
+
+def absolute_name(name, origin):
+    if name == '@':
+        return origin
+    if name.endswith('.') or not origin:
+        return name
+    return '%s.%s' % (name, origin)
+
+
+class ZoneParser(object):
+    """Turns tokenized entries into records.
+
+    origin and ttl follow the $ORIGIN and $TTL directives while parsing.
+    Relative names are completed with the origin, which must be absolute
+    (ending with a dot) or empty to keep names relative. $INCLUDE paths
+    are relative to the directory of filename.
+    """
+
+    def __init__(self, origin='', ttl=None, filename=None):
+        self.origin = origin
+        self.ttl = ttl
+        self.filename = filename
+
+    def parse(self, lines):
+        owner = None
+        depth = 0
+        new_record = tuple.__new__
+        (filename, origin, default_ttl) = (self.filename, self.origin, self.ttl)
+        for n, line in enumerate(lines):
+            if depth == 0 and ('"' not in line and '(' not in line and
+                               ')' not in line and '\\' not in line):
+                # fast path, most of the lines of a zone are plain records
+                data, sep, comment = line.partition(';')
+                tokens = data.split()
+                if not tokens:
+                    continue
+                start = n
+                blank = line[0] in ' \t'
+                if sep:
+                    comment = comment.strip()
+            else:
+                if depth == 0:
+                    start = n
+                    blank = line[0] in ' \t'
+                    tokens = []
+                    comments = []
+                depth = self._tokenize(n, line, depth, tokens, comments)
+                if depth or not tokens:
+                    continue
+                comment = comments[0] if comments else ''
+
+            if blank:
+                if owner is None:
+                    raise ZoneSyntaxError("Record without owner at line %d" %
+                                          (start + 1))
+                pos = 0
+            else:
+                first = tokens[0]
+                if first[0] == '$':
+                    for record in self._directive(start, tokens):
+                        yield record
+                    (origin, default_ttl) = (self.origin, self.ttl)
+                    continue
+                elif first == '@':
+                    owner = origin
+                elif first[-1] == '.' or not origin:
+                    owner = first
+                else:
+                    owner = first + '.' + origin
+                pos = 1
+
+            ttl = None
+            rclass = None
+            try:
+                rtype = tokens[pos]
+                if rtype not in TYPES:
+                    # TTL and class are optional and may come in any order
+                    for i in (0, 1):
+                        if rtype.isdigit():
+                            ttl = int(rtype)
+                        elif rtype[0].isdigit():
+                            ttl = parse_ttl(rtype)
+                        elif rtype.upper() in CLASSES:
+                            rclass = rtype.upper()
+                        else:
+                            break
+                        pos += 1
+                        rtype = tokens[pos]
+                    rtype = rtype.upper()
+            except IndexError:
+                raise ZoneSyntaxError("Record without type at line %d" %
+                                      (start + 1))
+
+            # tuple.__new__ skips the slow namedtuple constructor
+            yield new_record(Record, (filename, start, n, owner, ttl, rclass,
+                                      rtype, tokens[pos + 1:], comment,
+                                      origin, default_ttl))
+
+        if depth:
+            raise ZoneSyntaxError("Unbalanced '(' at line %d" % (start + 1))
+
+    def _tokenize(self, n, line, depth, tokens, comments):
+        # quoted strings, escapes and parentheses, returns the new depth
+        for match in TOKEN_RE.finditer(line):
+            token = match.group()
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                depth -= 1
+                if depth < 0:
+                    raise ZoneSyntaxError("Unbalanced ')' at line %d" % (n + 1))
+            elif token[0] == ';':
+                comments.append(token[1:].strip())
+            else:
+                tokens.append(token)
+        return depth
+
+    def _directive(self, start, tokens):
+        directive = tokens[0].upper()
+        if len(tokens) < 2:
+            raise ZoneSyntaxError("%s without value at line %d" %
+                                  (directive, start + 1))
+        if directive == '$ORIGIN':
+            self.origin = absolute_name(tokens[1], self.origin)
+        elif directive == '$TTL':
+            self.ttl = parse_ttl(tokens[1])
+        elif directive == '$INCLUDE':
+            filename = tokens[1]
+            if self.filename and not os.path.isabs(filename):
+                filename = os.path.join(os.path.dirname(self.filename),
+                                        filename)
+            origin = self.origin
+            if len(tokens) > 2:
+                origin = absolute_name(tokens[2], self.origin)
+            # the included file can not change the origin of this one
+            parser = ZoneParser(origin, self.ttl, filename)
+            with open(filename, 'r') as includefile:
+                for record in parser.parse(includefile):
+                    yield record
+        elif directive != '$GENERATE':
+            raise ZoneSyntaxError("Unknown directive %s at line %d" %
+                                  (directive, start + 1))
+
+
+def parse_zone(lines, origin='', ttl=None, filename=None):
+    return ZoneParser(origin, ttl, filename).parse(lines)
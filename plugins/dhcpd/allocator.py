@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) <2012> Antonio Pérez-Aranda Alcaide (ant30) <ant30tx@gmail.com>
+#                      Antonio Pérez-Aranda Alcaide (Yaco Sistemas SL) <aperezaranda@yaco.es>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of copyright holders nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL COPYRIGHT HOLDERS OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+import socket
+import struct
+
+from ipaddr import IPv4Address
+
+
+def ip_to_int(ip):
+    return struct.unpack('!I', socket.inet_aton(str(ip)))[0]
+
+
+class IPAllocator(object):
+    """Assigned addresses of a subnet, one byte per address.
+
+    Every byte counts the hosts using the address, the network and
+    broadcast addresses, the dynamic ranges and the reserved addresses
+    are never free. The scan for a free address starts at the lowest one
+    that may be free, so it is O(1) amortized while addresses are taken.
+    """
+
+    def __init__(self, network, ranges=(), reserved=()):
+        self.network = network
+        self.first = int(network.network)
+        self.map = bytearray(network.numhosts)
+        if network.prefixlen < 31:
+            self.map[0] = self.map[-1] = 1
+        for (start, end) in ranges:
+            start = max(ip_to_int(start) - self.first, 0)
+            end = min(ip_to_int(end) - self.first, len(self.map) - 1)
+            if start <= end:
+                self.map[start:end + 1] = '\x01' * (end - start + 1)
+        for ip in reserved:
+            self.use(ip)
+        self.cursor = 0
+        # hosts and active leases in the subnet, for the stats
+        self.hosts = 0
+        self.leases = 0
+
+    def _offset(self, ip):
+        try:
+            offset = ip_to_int(ip) - self.first
+        except socket.error:
+            return None
+        if 0 <= offset < len(self.map):
+            return offset
+        return None
+
+    def use(self, ip):
+        offset = self._offset(ip)
+        if offset is not None and self.map[offset] < 255:
+            self.map[offset] += 1
+
+    def release(self, ip):
+        offset = self._offset(ip)
+        if offset is not None and self.map[offset]:
+            self.map[offset] -= 1
+            if not self.map[offset]:
+                self.cursor = min(self.cursor, offset)
+
+    def is_free(self, ip):
+        offset = self._offset(ip)
+        return offset is not None and not self.map[offset]
+
+    def free_count(self):
+        return self.map.count('\x00')
+
+    def __contains__(self, ip):
+        return self._offset(ip) is not None
+
+    def next_free(self):
+        """First free address, None when the subnet is full"""
+        offset = self.map.find('\x00', self.cursor)
+        if offset < 0:
+            self.cursor = len(self.map)
+            return None
+        self.cursor = offset
+        return str(IPv4Address(self.first + offset))
+
+
+class SubnetsAllocator(object):
+    """IPAllocator of every subnet of a file
+
+    use() and release() take and give back the addresses of hosts,
+    sync_leases() the ones of the active leases.
+    """
+
+    def __init__(self, subnets):
+        self.allocators = [IPAllocator(subnet['network'],
+                                       ranges=subnet['ranges'],
+                                       reserved=subnet['routers'])
+                           for subnet in subnets]
+        # addresses of the active leases marked as taken
+        self.leased = set()
+        self.leases_version = None
+
+    def sync_leases(self, leased, version):
+        """Takes the addresses in leased, releasing the ones leased before"""
+        if version == self.leases_version:
+            return
+        leased = set(leased)
+        for ip in self.leased - leased:
+            allocator = self._allocator(ip)
+            if allocator:
+                allocator.release(ip)
+                allocator.leases -= 1
+        for ip in leased - self.leased:
+            allocator = self._allocator(ip)
+            if allocator:
+                allocator.use(ip)
+                allocator.leases += 1
+        self.leased = leased
+        self.leases_version = version
+
+    def _allocator(self, ip):
+        try:
+            ip = ip_to_int(ip)
+        except socket.error:
+            return None
+        for allocator in self.allocators:
+            if 0 <= ip - allocator.first < len(allocator.map):
+                return allocator
+        return None
+
+    def use(self, ip):
+        allocator = self._allocator(ip)
+        if allocator:
+            allocator.use(ip)
+            allocator.hosts += 1
+
+    def release(self, ip):
+        allocator = self._allocator(ip)
+        if allocator:
+            allocator.release(ip)
+            allocator.hosts -= 1
+
+    def is_free(self, ip):
+        allocator = self._allocator(ip)
+        return allocator is not None and allocator.is_free(ip)
+
+    def next_free(self):
+        for allocator in self.allocators:
+            ip = allocator.next_free()
+            if ip:
+                return ip
+        return None
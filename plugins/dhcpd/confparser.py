@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) <2012> Antonio Pérez-Aranda Alcaide (ant30) <ant30tx@gmail.com>
+#                      Antonio Pérez-Aranda Alcaide (Yaco Sistemas SL) <aperezaranda@yaco.es>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of copyright holders nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL COPYRIGHT HOLDERS OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Parser for dhcpd.conf files.
+
+parse_conf() reads the whole file in a single pass over its statements and
+returns the tree of its blocks (shared-network, subnet, group, pool,
+host...), each one with its statements and its span in the file, so a
+block can be found and replaced without parsing the file again.
+"""
+import re
+
+# the words of a statement up to a brace, a semicolon or a comment
+SEGMENT_RE = re.compile(r'((?:[^{};#"]+|"(?:[^"\\]|\\.)*"|")*)'
+                        r'([{};]|#[^\n]*|$)')
+WORD_RE = re.compile(r'"(?:[^"\\]|\\.)*"|[^\s"]+|"')
+
+
+class DhcpdSyntaxError(ValueError):
+    pass
+
+
+class Block(object):
+    """A block of the file, the root block is the file itself.
+
+    start and end are the offsets of its first token and after its
+    closing brace, comment is the text of the comments right before it,
+    which start at comment_start.
+    """
+    __slots__ = ('kind', 'args', 'start', 'end', 'comment', 'comment_start',
+                 'statements', 'children')
+
+    def __init__(self, kind, args, start, comment='', comment_start=None):
+        self.kind = kind
+        self.args = args
+        self.start = start
+        self.end = None
+        self.comment = comment
+        self.comment_start = start if comment_start is None else comment_start
+        self.statements = []
+        self.children = []
+
+    def find(self, kind):
+        """Blocks of kind under this one, in file order"""
+        for child in self.children:
+            if child.kind == kind:
+                yield child
+            for block in child.find(kind):
+                yield block
+
+    def option(self, *names):
+        """Arguments of the first statement starting with names"""
+        size = len(names)
+        for statement in self.statements:
+            if tuple(statement[:size]) == names:
+                return statement[size:]
+        return None
+
+
+def _line(content, pos):
+    return content.count('\n', 0, pos) + 1
+
+
+def parse_conf(content):
+    root = Block(None, [], 0)
+    stack = [root]
+    tokens = []
+    comments = []
+    (start, comment_start) = (None, None)
+    for match in SEGMENT_RE.finditer(content):
+        (text, end) = match.groups()
+        if text and not text.isspace():
+            if not tokens:
+                start = match.start() + len(text) - len(text.lstrip())
+            # quoted strings may hold spaces
+            tokens.extend(WORD_RE.findall(text) if '"' in text
+                          else text.split())
+        if not end:
+            continue
+
+        separator = end[0]
+        if separator == ';':
+            if tokens:
+                stack[-1].statements.append(tokens)
+                tokens = []
+            comments = []
+        elif separator == '#':
+            if not tokens:
+                if not comments:
+                    comment_start = match.start(2)
+                comments.append(end[1:].strip())
+        elif separator == '{':
+            if not tokens:
+                raise DhcpdSyntaxError("Block without name at line %d" %
+                                       _line(content, match.start(2)))
+            block = Block(tokens[0], tokens[1:], start, '\n'.join(comments),
+                          comment_start if comments else None)
+            stack[-1].children.append(block)
+            stack.append(block)
+            tokens = []
+            comments = []
+        else:
+            if tokens or len(stack) == 1:
+                raise DhcpdSyntaxError("Unexpected '}' at line %d" %
+                                       _line(content, match.start(2)))
+            stack.pop().end = match.end()
+            comments = []
+
+    if tokens:
+        raise DhcpdSyntaxError("Missing ';' at line %d" % _line(content, start))
+    if len(stack) > 1:
+        raise DhcpdSyntaxError("Unclosed %s block at line %d" %
+                               (stack[-1].kind,
+                                _line(content, stack[-1].start)))
+    root.end = len(content)
+    return root
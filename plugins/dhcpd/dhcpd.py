@@ -29,33 +29,36 @@
 # 
 
 from datetime import datetime
+import gc
 import re
-import shutil
-import subprocess
 from ipaddr import IPv4Network, IPv4Address
 
 
-from ninjasysop.backends import Backend, BackendApplyChangesException
+from ninjasysop.backends import (Backend, BackendApplyChangesException,
+                                 IndexedItems, atomic_files, bound_schema,
+                                 parsed_files, run_command)
+from ninjasysop.revisions import RevisionStore
 from ninjasysop.validators import IntegrityException
 import deform
 
+from allocator import SubnetsAllocator
+from confparser import parse_conf
+from leases import LeaseFile
+from networks import networks
 from texts import texts
-from forms import HostSchema, DhcpHostValidator
+from forms import HostSchema, DhcpHostValidator, validate_hosts
 
-# SERIAL = yyyymmddnn ; serial
-PARSER_RE = {
-    'partition':re.compile(r"(?P<sub>subnet[^\}]*}) *(?P<hosts>.*)$"),
-    'header': re.compile("subnet (?P<subnet>[\d.]+) netmask (?P<netmask>[\d\.]+)(?: *|)\{(?: *|)range (?P<start>[\d\.]+) (?P<end>[\d\.]+)"),
-    'hosts': re.compile(r"host (?P<hostname>[^ ]*) *{ *hardware ethernet (?P<mac>[^\;]*); *fixed-address (?P<ip>[^\;]*)"),
-    'router': re.compile(r"option routers (?P<router>[\d.]+)")
-}
+RELOAD_COMMAND = "/etc/init.d/isc-dhcpd-server reload"
+
+LINE_END_RE = re.compile(r'[ \t]*\n?')
+
+# the name is hidden when editing, typed when adding
+NAME_WIDGET = deform.widget.TextInputWidget()
 
-MATCH_RE_STR = {
-    'record':r'^{name} *(?:\d+ *|)(?:IN *|){rtype}',
-}
 
-RELOAD_COMMAND = "/etc/init.d/isc-dhcpd-server reload"
 
+def normalize_mac(mac):
+    return mac.lower()
 
 
 class DhcpHost(object):
@@ -78,38 +81,80 @@ class DhcpHost(object):
 class NetworkFile(object):
     def __init__(self, filename):
         self.filename = filename
+        # the file cut around the host blocks, an edit only replaces
+        # the piece of its host
+        self.pieces = []
+        # host name -> index of its piece
+        self.index = {}
+
+    def __subnet(self, block):
+        ranges = []
+        for pool in [block] + list(block.find('pool')):
+            for statement in pool.statements:
+                if statement[0] != 'range':
+                    continue
+                addresses = [ip for ip in statement[1:] if ip != 'dynamic-bootp']
+                ranges.append((IPv4Address(addresses[0]),
+                               IPv4Address(addresses[-1])))
+        routers = [IPv4Address(router.rstrip(','))
+                   for router in block.option('option', 'routers') or ()]
+        return dict(network=IPv4Network("%s/%s" % (block.args[0],
+                                                   block.args[2])),
+                    start=ranges[0][0] if ranges else None,
+                    end=ranges[0][1] if ranges else None,
+                    ranges=ranges,
+                    router=routers[0] if routers else None,
+                    routers=routers,
+                    )
 
     def readfile(self):
-        serial = ''
-        items = {}
+        items = IndexedItems(('ip', 'mac'), normalize={'mac': normalize_mac})
         with open(self.filename, 'r') as networkfile:
             content = networkfile.read()
-            partition = PARSER_RE['partition'].search(content.replace("\n",""))
-            if not partition:
-                raise IOError("Bad File Format")
-            (header, hosts) = partition.groups()
-
-            parsed_header = PARSER_RE['header'].search(header)
-            route_header = PARSER_RE['router'].search(header)
-            network = dict(network=IPv4Network("%s/%s" % (parsed_header.group('subnet'),
-                                                        parsed_header.group('netmask'),
-                                                       )),
-                           start=IPv4Address(parsed_header.group('start')),
-                           end=IPv4Address(parsed_header.group('end')),
-                           router=IPv4Address(route_header.group('router')),
-                           )
-
-            parsed_hosts = PARSER_RE['hosts'].findall(hosts)
-            for (name, mac, ip) in parsed_hosts:
-                item = DhcpHost(name, mac, ip)
-                items[name] = item
-
-        return (network, items)
+
+        # the collector would walk the blocks built so far many times
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            conf = parse_conf(content)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        subnets = [self.__subnet(block) for block in conf.find('subnet')]
+        if not subnets:
+            raise IOError("Bad File Format")
+
+        self.pieces = []
+        self.index = {}
+        pos = 0
+        for block in conf.find('host'):
+            mac = block.option('hardware', 'ethernet')
+            ip = block.option('fixed-address')
+            # hosts matched by other means can not be edited
+            if not mac or not ip:
+                continue
+            name = block.args[0].strip('"')
+            items[name] = DhcpHost(name, mac[0], ip[0].rstrip(','),
+                                   block.comment)
+
+            # the piece takes the comments before the host and the end
+            # of its last line
+            end = LINE_END_RE.match(content, block.end).end()
+            self.pieces.append(content[pos:block.comment_start])
+            self.index[name] = len(self.pieces)
+            self.pieces.append(content[block.comment_start:end])
+            pos = end
+        self.pieces.append(content[pos:])
+
+        return (subnets, items)
 
     def __str_item(self, item):
         itemstr = ''
         if item.comment:
-            itemstr = "#{0}\n".format(item.comment)
+            # the comment holds every comment line before the host
+            itemstr = ''.join("#{0}\n".format(line)
+                              for line in item.comment.split('\n'))
 
         itemstr += "host {name} {{\n hardware ethernet {mac};\n fixed-address {ip};\n}}\n".format(
                                     name=item.name, mac=item.mac, ip=item.ip)
@@ -117,59 +162,88 @@ class NetworkFile(object):
         return itemstr
 
 
-    def add_item(self, item):
-
-        with open(self.filename, 'r') as filecontent:
+    def __content(self):
+        return ''.join(self.pieces)
 
-            item_str = self.__str_item(item)
-            content = filecontent.read()
-            content = content + item_str
+    def __writefile(self):
+        # joined only when written, once for a batch of edits
+        atomic_files.write(self.filename, self.__content)
 
-        with open(self.filename, 'w') as filecontent:
-            filecontent.write(content)
+    def __piece(self, item):
+        try:
+            return self.index.pop(item.name)
+        except KeyError:
+            raise KeyError("host %s not found" % item.name)
 
+    def add_item(self, item):
+        self.add_items([item])
+
+    def add_items(self, items):
+        # the last piece with text may be a host without a line end
+        for n in xrange(len(self.pieces) - 1, -1, -1):
+            if self.pieces[n]:
+                if not self.pieces[n].endswith('\n'):
+                    self.pieces[n] += '\n'
+                break
+        for item in items:
+            self.index[item.name] = len(self.pieces)
+            self.pieces.append(self.__str_item(item))
+        self.__writefile()
 
     def save_item(self, old_item, item):
-
-        with open(self.filename, 'r') as filecontent:
-
-            item_str = self.__str_item(item)
-            content = filecontent.read()
-            content_1 = re.sub(r"host %s [^\{]*{.*[^\}]*} *\n" % (old_item.name),
-                    item_str, content)
-            if content == content_1:
-                raise KeyError("host %s not found" % item.name)
-            else:
-                content = content_1
-
-        with open(self.filename, 'w') as filecontent:
-            filecontent.write(content)
+        n = self.__piece(old_item)
+        self.pieces[n] = self.__str_item(item)
+        self.index[item.name] = n
+        self.__writefile()
 
     def remove_item(self, item):
-        with open(self.filename, 'r') as filecontent:
+        self.pieces[self.__piece(item)] = ''
+        self.__writefile()
 
-            content = filecontent.read()
-            content_1 = re.sub(r"host %s [^\{]*{.*[^\}]*} *\n" % (item.name),
-                               "", content)
-            if content == content_1:
-                raise KeyError("host %s not found" % item.name)
-            else:
-                content = content_1
 
-        with open(self.filename, 'w') as filecontent:
-            filecontent.write(content)
+def read_network(filename):
+    networkfile = NetworkFile(filename)
+    (subnets, items) = networkfile.readfile()
+    allocator = SubnetsAllocator(subnets)
+    for item in items.itervalues():
+        allocator.use(item.ip)
+    return (networkfile, subnets, items, allocator)
 
 
 class Dhcpd(Backend):
 
+    leases = None
+
     def __init__(self, name, filename):
         super(Dhcpd, self).__init__(name, filename)
-        self.networkfile = NetworkFile(filename)
-        (self.network, self.items) = self.networkfile.readfile()
+        self.refresh()
+        self.revisions = RevisionStore(filename, self.revisions_keep)
+
+    def refresh(self):
+        # the networkfile keeps the pieces of the parsed hosts, so it is
+        # cached along with them
+        if super(Dhcpd, self).stale():
+            self.stamp = parsed_files.stamp(self.filename)
+            (self.networkfile, self.subnets, self.items,
+             self.allocator) = parsed_files.get(self.filename, self._readfile)
+            self.network = self.subnets[0]
+            networks.register(self.name, self.subnets, self.items)
+        self._sync_leases()
+
+    def stale(self):
+        if self.leases is not None and self.stamp is not None:
+            # reads the new leases, if any
+            self.leases.active()
+            if self.leases.version != self.allocator.leases_version:
+                return True
+        return super(Dhcpd, self).stale()
 
     def del_item(self, name):
-        self.networkfile.remove_item(self.items[name])
-        del self.items[name]
+        with self.batch():
+            self.networkfile.remove_item(self.items[name])
+            self.allocator.release(self.items[name].ip)
+            networks.remove_host(self.name, self.items[name])
+            del self.items[name]
 
     def get_item(self, name):
         if name in self.items:
@@ -177,51 +251,36 @@ class Dhcpd(Backend):
         else:
             return None
 
-    def get_items(self, **kwargs):
-        filters = []
+    def get_items(self, name=None, mac=None, ip=None, name_exact=None,
+                  offset=0, limit=None, order=None):
+        return self.items.filter(name=name, name_exact=name_exact,
+                                 mac=mac, ip=ip, offset=offset, limit=limit,
+                                 order=order)
 
-        if 'name' in kwargs:
-            def filter_name(r):
-                return r.name.find(kwargs['name']) >= 0
-            filters.append(filter_name)
+    def get_items_by_ip(self, ip):
+        return list(self.items.index.lookup('ip', ip))
 
-        if 'mac' in kwargs:
-            def filter_mac(r):
-                return r.mac == kwargs['mac']
-            filters.append(filter_type)
+    def get_items_by_mac(self, mac):
+        return list(self.items.index.lookup('mac', mac))
 
-        if 'ip' in kwargs:
-            def filter_target(r):
-                return r.ip == kwargs['ip']
-            filters.append(filter_target)
+    def get_ip_group(self, ip):
+        """Group of any dhcpd file whose subnets hold ip"""
+        return networks.group_of(ip)[0]
 
-        if 'name_exact' in kwargs:
-            def filter_name_exact(r):
-                return r.name == kwargs['name']
-            filters.append(filter_name_exact)
+    def get_mac_hosts(self, mac):
+        """(group, host name) of the hosts of any dhcpd file using mac"""
+        return networks.hosts_with_mac(mac)
 
-        if filters:
-            return filter(lambda item: all([f(item) for f in filters]),
-                         self.items.values())
-        else:
-            return self.items.values()
+    def is_free_ip(self, ip):
+        """Not used by a host, a lease, a router or a dynamic range"""
+        return self.allocator.is_free(ip)
 
     def get_free_ip(self):
         # A free IP is:
         #   * Not asigned IP
         #   * Not in DHCPD start/end range (not ip collisions)
         #   * A IP in network (subnet/netmask) range
-        start_ip = self.network['network'].ip
-        ip = start_ip + 1
-        while (not (ip > self.network['start'] and ip < self.network['start']) and
-               not (self.get_items(ip=ip.exploded)) and
-               ip in self.network['network']):
-            ip += 1
-
-        if ip not in self.network['network']:
-            return ""
-        else:
-            return ip.exploded
+        return self.allocator.next_free() or ""
 
     def add_item(self, obj):
         item = DhcpHost(name=obj['name'],
@@ -230,36 +289,88 @@ class Dhcpd(Backend):
                     #comment=obj['comment'],
                     )
 
-        self.networkfile.add_item(item)
-        self.items[str(item)] = item
+        with self.batch():
+            self.networkfile.add_item(item)
+            self.items[str(item)] = item
+            self.allocator.use(item.ip)
+            networks.add_host(self.name, item)
+        return item
+
+    def validate_items(self, objs):
+        return validate_hosts(self, objs)
+
+    def add_items(self, objs):
+        """Adds the validated hosts with a single write"""
+        items = [DhcpHost(name=obj['name'], mac=obj['mac'], ip=obj['ip'])
+                 for obj in objs]
+        with self.batch():
+            self.networkfile.add_items(items)
+            for item in items:
+                self.items[str(item)] = item
+                self.allocator.use(item.ip)
+                networks.add_host(self.name, item)
+        return items
 
     def save_item(self, old_item, obj):
         item = DhcpHost(name=obj['name'],
                     mac=obj['mac'],
                     ip=obj['ip'],
                     #comment=obj['comment'],
+                    # the comment is rewritten with the host
+                    comment=old_item.comment,
                     )
 
-        self.networkfile.save_item(old_item, item)
-        self.items[str(old_item)] = item
+        with self.batch():
+            self.networkfile.save_item(old_item, item)
+            del self.items[str(old_item)]
+            self.items[str(item)] = item
+            self.allocator.release(old_item.ip)
+            self.allocator.use(item.ip)
+            networks.remove_host(self.name, old_item)
+            networks.add_host(self.name, item)
+        return item
+
+    def _sync_leases(self):
+        # suggested IPs must not be leased
+        if self.leases is not None:
+            self.allocator.sync_leases(self.leases.active(),
+                                       self.leases.version)
+
+    def get_stats(self):
+        # the allocators count the hosts and the leases as they change
+        return [(allocator.network.exploded,
+                 "%d hosts, %d leases, %d free" %
+                 (allocator.hosts, allocator.leases, allocator.free_count()))
+                for allocator in self.allocator.allocators]
+
+    def get_subnet(self, ip):
+        ip = IPv4Address(ip)
+        for subnet in self.subnets:
+            if ip in subnet['network']:
+                return subnet
+        return None
+
+    def _readfile(self):
+        return read_network(self.filename)
+
+    def _update_cache(self):
+        self.stamp = parsed_files.update(self.filename,
+                                         (self.networkfile, self.subnets,
+                                          self.items, self.allocator))
 
     def get_edit_schema(self, name):
-        return HostSchema(validator=DhcpHostValidator(self))
+        return bound_schema(HostSchema,
+                            DhcpHostValidator(self, old=self.get_item(name)))
 
     def get_add_schema(self):
-        schema = HostSchema(validator=DhcpHostValidator(self, new=True))
-        for field in schema.children:
-            if field.name == 'name':
-                field.widget = deform.widget.TextInputWidget()
-            if field.name == 'ip':
-                free_ip = self.get_free_ip()
-                if free_ip:
-                    field.default = self.get_free_ip()
-                    field.description = "You can use %s as available IP" % free_ip
-                else:
-                    field.description = "There aren't available IPs"
-
-        return schema
+        free_ip = self.get_free_ip()
+        if free_ip:
+            ip = {'default': free_ip,
+                  'description': "You can use %s as available IP" % free_ip}
+        else:
+            ip = {'description': "There aren't available IPs"}
+        return bound_schema(HostSchema, DhcpHostValidator(self, new=True),
+                            name={'widget': NAME_WIDGET}, ip=ip)
 
 
     def _timestamp(self):
@@ -268,14 +379,54 @@ class Dhcpd(Backend):
 
 
     def apply_changes(self, username):
+        return self.revisions.save(self._timestamp(), username)
+
+    def reload(self, revision):
         cmd=RELOAD_COMMAND
-        save_filename = "%s.%s.%s" % (self.filename, self._timestamp(), username)
-        shutil.copy(self.filename, save_filename)
-        try:
-            subprocess.check_output("%s" % cmd,
-                                    stderr=subprocess.STDOUT, shell=True)
-        except subprocess.CalledProcessError, e:
-            raise BackendApplyChangesException(e.output)
+        run_command(cmd, self.apply_timeout)
+
+    def get_revisions(self):
+        return self.revisions.list()
+
+    def restore_revision(self, serial):
+        revision = self.revisions.restore(serial)
+        self.refresh()
+        return revision
+
+    @classmethod
+    def configure(cls, settings):
+        from ninjasysop import get_files
+        super(Dhcpd, cls).configure(settings)
+        networks.configure(get_files(settings, 'dhcpd'))
+        leases = settings.get('ninjasysop.leases')
+        cls.leases = LeaseFile(leases) if leases else None
+
+    @classmethod
+    def source_files(cls, filename):
+        # the leases are part of the group stats
+        if cls.leases is not None:
+            return [filename, cls.leases.filename]
+        return [filename]
+
+    @classmethod
+    def source_state(cls):
+        # the leases that expire change the stats, not the files
+        if cls.leases is not None:
+            cls.leases.active()
+            return (cls.leases.next_expiry,)
+        return ()
+
+    @classmethod
+    def lookup(cls, ip=None, mac=None):
+        result = {}
+        if ip:
+            (group, network) = networks.group_of(ip)
+            result['ip'] = dict(group=group,
+                                network=network and network.exploded)
+        if mac:
+            result['mac'] = [dict(group=group, name=name)
+                             for (group, name) in networks.hosts_with_mac(mac)]
+        return result
 
     @classmethod
     def get_edit_schema_definition(self):
@@ -34,8 +34,6 @@ import deform
 
 from ninjasysop.validators import name_validator, ip_validator, mac_validator
 
-from ipaddr import IPv4Address
-
 
 class HostSchema(colander.MappingSchema):
     name = colander.SchemaNode(
@@ -52,39 +50,95 @@ class HostSchema(colander.MappingSchema):
 
 
 
+def host_errors(group, host, edited=None):
+    """(field, message) pairs of what is wrong with host in group.
+
+    edited is the host being edited, which keeps its name and may keep
+    its IP and MAC. A new IP must be free: not taken by another host, a
+    lease, a router or a dynamic range of its subnet.
+    """
+    (name, ip, mac) = (host['name'], host['ip'], host['mac'])
+    errors = []
+    if edited is None and group.get_item(name):
+        errors.append(('name', "Entry host already exist"))
+
+    hosts = [item for item in group.get_items_by_ip(ip)
+             if edited is None or item.name != edited.name]
+    if group.get_subnet(ip) is None:
+        owner = group.get_ip_group(ip)
+        if owner:
+            errors.append(('ip', "This IP belongs to the group %s" % owner))
+        else:
+            errors.append(('ip', "%s is not in the subnets" % ip))
+    elif hosts:
+        errors.append(('ip', "IP is already assigned to host %s" %
+                       hosts[0].name))
+    elif ((edited is None or ip != edited.ip) and
+          not group.is_free_ip(ip)):
+        errors.append(('ip', "IP is in a dynamic range, reserved or leased"))
+
+    hosts = [item for item in group.get_items_by_mac(mac)
+             if edited is None or item.name != edited.name]
+    if hosts:
+        errors.append(('mac', "MAC is already assigned to host %s" %
+                       hosts[0].name))
+    else:
+        reserved = [group_name for (group_name, host_name)
+                    in group.get_mac_hosts(mac) if group_name != group.name]
+        if reserved:
+            errors.append(('mac', "MAC is already reserved in %s" %
+                           reserved[0]))
+    return errors
+
+
 class DhcpHostValidator:
 
-    def __init__(self, group, new=False):
+    def __init__(self, group, new=False, old=None):
         self.group = group
         self.new = new
+        self.old = old
 
     def __call__(self, form, value):
-        from dhcpd import DhcpHost
-        item = DhcpHost(**value)
-
-
         if self.new:
-            item_group = self.group.get_item(item.name)
-            if item_group:
-                exc = colander.Invalid(form, 'Entry Host already exist')
-                exc['name'] = colander.Invalid(
-                      form, "Entry host already exist")
-                raise exc
-
-        # verify IP is not duplicated
-        ips = self.group.get_items(ip=item.ip)
-
-        if ((self.new and len(ips) > 0 ) or
-            (not self.new and len(ips) == 1 and ips[0].name != item.name)):
-            exc = colander.Invalid(form, 'Entry IP already assigned to host %s' % (ips[0].name))
-            exc['ip'] = colander.Invalid(
-                  form, "IP is already assigned, select another ip")
+            edited = None
+        else:
+            edited = self.old or self.group.get_item(value['name'])
+
+        errors = host_errors(self.group, value, edited)
+        if errors:
+            exc = colander.Invalid(form, errors[0][1])
+            for (field, message) in errors:
+                exc[field] = colander.Invalid(form, message)
             raise exc
 
-        ## TODO: verify IP is in correct range taken from header file
-        if IPv4Address(item.ip) not in self.group.network['network']:
-            exc = colander.Invalid(form, '%s is not a valid IP' % (item.ip))
-            exc['ip'] = colander.Invalid(
-                  form, "This IP is not a valid IP")
-            raise exc
 
+def validate_hosts(group, rows):
+    """Validates the hosts of an import together.
+
+    Returns the deserialized hosts and a list of (row, field, message)
+    errors, checking every host with host_errors() and against the
+    previous rows.
+    """
+    schema = HostSchema()
+    values = []
+    errors = []
+    (names, ips, macs) = (set(), set(), set())
+    for (n, row) in enumerate(rows):
+        try:
+            value = schema.deserialize(row)
+        except colander.Invalid, e:
+            errors.extend((n, field, message)
+                          for (field, message) in sorted(e.asdict().items()))
+            continue
+
+        row_errors = dict(host_errors(group, value))
+        for (field, key, seen) in (('name', value['name'], names),
+                                   ('ip', value['ip'], ips),
+                                   ('mac', value['mac'].lower(), macs)):
+            if key in seen:
+                row_errors.setdefault(field, "Repeated in the import")
+            if field in row_errors:
+                errors.append((n, field, row_errors[field]))
+            seen.add(key)
+        values.append(value)
+    return (values, errors)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) <2012> Antonio Pérez-Aranda Alcaide (ant30) <ant30tx@gmail.com>
+#                      Antonio Pérez-Aranda Alcaide (Yaco Sistemas SL) <aperezaranda@yaco.es>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of copyright holders nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL COPYRIGHT HOLDERS OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Reader of the dhcpd.leases file.
+
+dhcpd only appends to its leases file, and from time to time writes a
+new one and renames it over the old one. LeaseFile maps the file and
+parses only what was appended since the last read, starting again when
+the file is replaced.
+"""
+import calendar
+import mmap
+import os
+import threading
+import time
+from collections import namedtuple
+
+from confparser import parse_conf
+
+Lease = namedtuple('Lease', ('ip', 'state', 'starts', 'ends', 'mac',
+                             'hostname'))
+
+
+def lease_time(tokens):
+    # "4 2012/01/31 10:00:00", "epoch 1328004000" or "never", in UTC
+    if not tokens or tokens[0] == 'never':
+        return None
+    if tokens[0] == 'epoch':
+        return int(tokens[1])
+    return calendar.timegm(time.strptime(' '.join(tokens[1:3]),
+                                         '%Y/%m/%d %H:%M:%S'))
+
+
+class LeaseFile(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.leases = {}
+        self.identity = None
+        self.offset = 0
+        # changes whenever the set of active leases may have changed
+        self.version = 0
+        self.next_expiry = None
+        self._active = None
+        self._lock = threading.Lock()
+
+    def update(self):
+        """Reads the leases appended since the last call"""
+        with self._lock:
+            try:
+                filestat = os.stat(self.filename)
+            except OSError:
+                return
+            identity = (filestat.st_dev, filestat.st_ino)
+            if identity != self.identity or filestat.st_size < self.offset:
+                # a new file written by dhcpd
+                self.leases = {}
+                self.offset = 0
+                self.identity = identity
+                self._changed()
+            if filestat.st_size == self.offset:
+                return
+
+            with open(self.filename, 'rb') as leasefile:
+                data = mmap.mmap(leasefile.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    # only up to the last complete lease
+                    end = data.rfind('\n}', self.offset) + 2
+                    if end < 2:
+                        return
+                    chunk = data[self.offset:end]
+                finally:
+                    data.close()
+
+            for block in parse_conf(chunk).children:
+                if block.kind != 'lease' or not block.args:
+                    continue
+                hardware = block.option('hardware', 'ethernet')
+                hostname = block.option('client-hostname')
+                # the last lease of an address is the current one
+                self.leases[block.args[0]] = Lease(
+                    block.args[0],
+                    ' '.join(block.option('binding', 'state') or ()),
+                    lease_time(block.option('starts')),
+                    lease_time(block.option('ends')),
+                    hardware[0] if hardware else None,
+                    hostname[0].strip('"') if hostname else None)
+            self.offset = end
+            self._changed()
+
+    def _changed(self):
+        self.version += 1
+        self._active = None
+
+    def active(self):
+        """Active leases by IP"""
+        self.update()
+        with self._lock:
+            now = time.time()
+            if self.next_expiry is not None and now >= self.next_expiry:
+                self._changed()
+            if self._active is None:
+                self._active = {}
+                self.next_expiry = None
+                for lease in self.leases.itervalues():
+                    if lease.state != 'active':
+                        continue
+                    if lease.ends is not None:
+                        if lease.ends <= now:
+                            continue
+                        self.next_expiry = min(self.next_expiry or lease.ends,
+                                               lease.ends)
+                    self._active[lease.ip] = lease
+            return self._active
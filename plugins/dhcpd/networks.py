@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) <2012> Antonio Pérez-Aranda Alcaide (ant30) <ant30tx@gmail.com>
+#                      Antonio Pérez-Aranda Alcaide (Yaco Sistemas SL) <aperezaranda@yaco.es>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of copyright holders nor the names of its
+#    contributors may be used to endorse or promote products derived
+#    from this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# ``AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED
+# TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL COPYRIGHT HOLDERS OR CONTRIBUTORS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""Subnets and MACs of every dhcpd group of the process.
+
+The subnets of all the configured files are kept in a binary prefix
+tree, so the group owning an IP is found walking at most its prefix
+length, and the MACs of all the hosts in a hash index.
+"""
+import socket
+import threading
+import time
+
+from ninjasysop.backends import parsed_files
+
+from allocator import ip_to_int
+
+# files changed by other processes are noticed after these seconds
+REFRESH_INTERVAL = 1
+
+
+class PrefixTree(object):
+    """Longest prefix match of IPv4 networks"""
+
+    def __init__(self):
+        # [zero child, one child, network, value]
+        self.root = [None, None, None, None]
+
+    def _walk(self, network, create):
+        address = int(network.network)
+        node = self.root
+        for bit in xrange(network.prefixlen):
+            branch = (address >> (31 - bit)) & 1
+            if node[branch] is None:
+                if not create:
+                    return None
+                node[branch] = [None, None, None, None]
+            node = node[branch]
+        return node
+
+    def insert(self, network, value):
+        node = self._walk(network, True)
+        node[2] = network
+        node[3] = value
+
+    def remove(self, network, value):
+        node = self._walk(network, False)
+        if node is not None and node[3] == value:
+            node[2] = node[3] = None
+
+    def lookup(self, ip):
+        """(network, value) of the longest network holding ip"""
+        address = ip_to_int(ip)
+        node = self.root
+        match = (node[2], node[3])
+        for bit in xrange(32):
+            node = node[(address >> (31 - bit)) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                match = (node[2], node[3])
+        return match
+
+
+class Networks(object):
+    """Owners of the subnets and the MACs of the dhcpd groups"""
+
+    def __init__(self):
+        self.files = {}
+        self.tree = PrefixTree()
+        # group -> (subnets, items) the tree and the macs were built from
+        self.groups = {}
+        # mac -> set of (group, host name)
+        self.macs = {}
+        self.refreshed = 0
+        self._lock = threading.RLock()
+
+    def configure(self, files):
+        with self._lock:
+            self.files = dict(files)
+            self.refreshed = 0
+
+    def register(self, group, subnets, items):
+        with self._lock:
+            if self.groups.get(group, (None, None))[1] is items:
+                return
+            self.unregister(group)
+            for subnet in subnets:
+                self.tree.insert(subnet['network'], group)
+            for item in items.itervalues():
+                self.add_host(group, item)
+            self.groups[group] = (subnets, items)
+
+    def unregister(self, group):
+        with self._lock:
+            (subnets, items) = self.groups.pop(group, (None, None))
+            if subnets is None:
+                return
+            for subnet in subnets:
+                self.tree.remove(subnet['network'], group)
+            for item in items.itervalues():
+                self.remove_host(group, item)
+
+    def add_host(self, group, item):
+        with self._lock:
+            self.macs.setdefault(item.mac.lower(), set()).add((group,
+                                                               item.name))
+
+    def remove_host(self, group, item):
+        with self._lock:
+            mac = item.mac.lower()
+            hosts = self.macs.get(mac)
+            if hosts is not None:
+                hosts.discard((group, item.name))
+                if not hosts:
+                    del self.macs[mac]
+
+    def _refresh(self):
+        # loads the groups whose file changed, at most once a second
+        if time.time() - self.refreshed < REFRESH_INTERVAL:
+            return
+        from dhcpd import read_network
+        for (group, filename) in self.files.items():
+            (networkfile, subnets, items, allocator) = parsed_files.get(
+                filename, lambda: read_network(filename))
+            self.register(group, subnets, items)
+        self.refreshed = time.time()
+
+    def group_of(self, ip):
+        """(group, network) owning ip, (None, None) if no group does"""
+        with self._lock:
+            self._refresh()
+            try:
+                (network, group) = self.tree.lookup(ip)
+            except socket.error:
+                return (None, None)
+            return (group, network)
+
+    def hosts_with_mac(self, mac):
+        """(group, host name) of the hosts using mac"""
+        with self._lock:
+            self._refresh()
+            return sorted(self.macs.get(mac.lower(), ()))
+
+
+networks = Networks()
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+#
+# Imports the hosts of a CSV (name,ip,mac header) or JSON file into a
+# dhcpd group with a single request:
+#
+#   ninja-dhcpd-import.py vlan1 rack42.csv
+
+import sys
+
+import requests
+import simplejson
+
+api_url = 'http://localhost:6543/api/'
+auth_url = 'http://localhost:6543/login/'
+user = 'admin'
+password = 'admin'
+
+if len(sys.argv) != 3:
+    print "Usage: %s group file.csv|file.json" % sys.argv[0]
+    sys.exit(1)
+
+(group, filename) = sys.argv[1:]
+with open(filename, 'r') as hostsfile:
+    content = hostsfile.read()
+if filename.endswith('.csv'):
+    content_type = 'text/csv'
+else:
+    content_type = 'application/json'
+
+auth_response = requests.post(auth_url, dict(login=user, password=password))
+cookies = auth_response.cookies
+
+response = requests.post(api_url + '%s/import/' % group, data=content,
+                         headers={'Content-Type': content_type},
+                         cookies=cookies)
+result = simplejson.loads(response.text)
+
+if 'errors' in result:
+    for error in result['errors']:
+        print " x-> row %(row)s, %(field)s: %(message)s" % error
+    sys.exit(1)
+
+print "%s hosts added to %s" % (result['added'], group)